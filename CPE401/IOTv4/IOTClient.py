@@ -7,22 +7,19 @@
 # Version: 1.0
 
 from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, gethostbyname, gethostname
-from threading import Thread, Timer
+from threading import Thread, Timer, Lock
+from concurrent.futures import Future
+from itertools import count
 import sqlite3
 import argparse as ap
-import hashlib
 import sys
+import os
 from time import time
 from random import randint
-
-# Use Command Line arguments to get pertinent information
-parser = ap.ArgumentParser()
-parser.add_argument("-d", "--device", required=True, help="The name of the device")
-parser.add_argument("-i", "--id", required=True, help="The deviceName for the cloud")
-parser.add_argument("-s", "--server", required=True, help="The IP of the server")
-parser.add_argument("-p", "--port", required=True, help="The port that the server is on")
-
-args = vars(parser.parse_args())
+from framing import encodeFrame, FrameBuffer
+from tokens import saveToken, loadToken, removeToken
+from protocol import decodeMessage, encodeMessage, tagMessage, untagMessage, digestMessage, verifyDigest, ASCII, \
+    BINARY, HELLO, SHA256, BLAKE2
 
 # Menu options for the user to select
 menu = {"1": "Register Device", "2": "Deregister Device",
@@ -31,30 +28,55 @@ menu = {"1": "Register Device", "2": "Deregister Device",
 
 
 # A Data Structure that holds all relevant functions pertaining to the
+# device. It can also be used without the menu, e.g. from sensor firmware or a load test:
+#   device = IOTclient("sensor1", "1", "toor", mac, 6700, "10.0.0.5", interactive=False)
+#   device.start()
+#   device.register().result()
+#   device.login().result()
+#   device.sendData("01", 1, "21.5C").result()
 class IOTclient:
-    # TCP Socket
-    tcpClient = socket(AF_INET, SOCK_STREAM)
-    # UDP Socket
-    udpClient = socket(AF_INET, SOCK_DGRAM)
-    # TCP Socket for AWS
-    tcpAWS = socket(AF_INET, SOCK_STREAM)
     addr = ''
     # Class Variables
     hostname = gethostname()
     IP = gethostbyname(hostname)
-    conn = sqlite3.connect("IOT.db")
-    h = hashlib.sha256()
     AWS_IP = ''
     AWS_PORT = 0
-
-    # Constructor for the Object
-    def __init__(self, d, id, pp, m, p, s):
+    # Messages to the server go out as ASCII until the server agrees to the binary encoding
+    codec = ASCII
+    # The binary encoding is smaller but costs more CPU than ASCII (see protocol.py), so it is only asked for when set
+    offerBinary = False
+    # ACK digests are SHA256 unless BLAKE2b is asked for and the server agrees. For messages this short neither
+    # is reliably faster (see protocol.py), so BLAKE2b is only asked for when set
+    offerBlake2 = False
+    digest = SHA256
+    # Each device's login token is kept here under its name until it runs out, None keeps tokens in memory only
+    TOKEN_DIR = "tokens"
+
+    # Constructor for the Object. With interactive off nothing is printed and
+    # errors are raised to the caller instead of exiting the program
+    def __init__(self, d, id, pp, m, p, s, interactive=True):
+        self.interactive = interactive
         self.deviceName = d
         self.deviceID = id
         self.passPhrase = pp
         self.MAC = m
         self.serverPort = p
         self.server = s, p
+        # Every device has its own sockets, so one process can run many devices
+        # TCP Socket
+        self.tcpClient = socket(AF_INET, SOCK_STREAM)
+        # UDP Socket
+        self.udpClient = socket(AF_INET, SOCK_DGRAM)
+        # TCP Socket for AWS
+        self.tcpAWS = socket(AF_INET, SOCK_STREAM)
+        self.conn = None
+        # Requests still waiting for their ACK, by request ID
+        self.pending = {}
+        self.pendingLock = Lock()
+        self.requestIds = count(1)
+        # The token from the last login, sent instead of the passphrase on the next one
+        self.tokenPath = os.path.join(self.TOKEN_DIR, self.deviceName + ".token") if self.TOKEN_DIR else None
+        self.token = loadToken(self.tokenPath) if self.tokenPath else None
 
     # This binds the client to the listening port
     def bindClient(self):
@@ -62,43 +84,108 @@ class IOTclient:
         self.udpClient.bind((self.IP, 0))
         self.tcpAWS.bind((self.IP, 0))
 
+    # Sends a message tagged with a new request ID. The Future resolves to the fields of the ACK that answers it,
+    # so many requests can be in flight at once. The message is kept to check the ACK's digest against
+    def request(self, msg):
+        future = Future()
+        with self.pendingLock:
+            requestId = next(self.requestIds)
+            self.pending[requestId] = (future, msg)
+        self.sendServerMessage(tagMessage(msg, requestId))
+        return future
+
+    # Hands an ACK to the request it answers, or fails the request if the ACK's digest is not of what was sent
+    def resolveRequest(self, requestId, msg):
+        with self.pendingLock:
+            entry = self.pending.pop(requestId, None)
+        if entry is None:
+            return
+        future, sent = entry
+        if len(msg) > 4 and not verifyDigest(sent, msg[4], self.digest):
+            future.set_exception(ValueError("ACK digest does not match the request"))
+        else:
+            future.set_result(msg)
+
+    # Fails every request still waiting once the server connection is gone
+    def failRequests(self):
+        with self.pendingLock:
+            waiting = list(self.pending.values())
+            self.pending.clear()
+        for future, sent in waiting:
+            future.set_exception(ConnectionError("Connection to the server closed"))
+
     # Send the register message to the server
     def register(self):
-        reg = ("REGISTER\t" + self.deviceName + "\t" + self.passPhrase + "\t" + self.MAC)
-        reg = reg.encode('ascii')
-        self.sendServerMessage(reg)
+        reg = ["REGISTER", self.deviceName, self.passPhrase, self.MAC]
+        return self.request(reg)
 
     # Send the deregister message to the server
     def deregister(self):
-        dereg = ("DEREGISTER\t" + self.deviceName + "\t" + self.passPhrase + "\t" + self.MAC)
-        dereg = dereg.encode('ascii')
-        self.sendServerMessage(dereg)
+        dereg = ["DEREGISTER", self.deviceName, self.passPhrase, self.MAC]
+        return self.request(dereg)
 
-    # Send the login message to the server
+    # Send the login message to the server. A token from an earlier login is sent in place of the passphrase,
+    # and if the server refuses it with ACK 71 the login is sent again with the passphrase.
+    # The Future resolves to the ACK that ends the login
     def login(self):
         port = self.udpClient.getsockname()
-        login = ("LOGIN\t" + self.deviceName + "\t" + self.passPhrase + "\t" + self.IP + "\t" + str(port[1]))
-        login = login.encode('ascii')
-        self.sendServerMessage(login)
+        login = ["LOGIN", self.deviceName, self.passPhrase, self.IP, str(port[1])]
+        result = Future()
+        if self.token is None:
+            self.request(login).add_done_callback(lambda done: self.finishLogin(done, result, None))
+        else:
+            tokenLogin = ["LOGIN", self.deviceName, self.token, self.IP, str(port[1])]
+            self.request(tokenLogin).add_done_callback(lambda done: self.finishLogin(done, result, login))
+        return result
 
-    # Send the logoff message to the server
+    # Keeps the token a successful login carries, or retries a refused token login with the passphrase
+    def finishLogin(self, done, result, retry):
+        try:
+            msg = done.result()
+        except Exception as error:
+            result.set_exception(error)
+            return
+        if msg[1] == '70' and len(msg) > 5:
+            self.setToken(msg[5])
+        elif msg[1] == '71' and retry is not None:
+            self.setToken(None)
+            try:
+                self.request(retry).add_done_callback(lambda again: self.finishLogin(again, result, None))
+            except OSError as error:
+                result.set_exception(error)
+            return
+        result.set_result(msg)
+
+    # Remembers the token, or forgets it when token is None, both here and on disk
+    def setToken(self, token):
+        self.token = token
+        if self.tokenPath is None:
+            return
+        if token is None:
+            removeToken(self.tokenPath)
+        else:
+            saveToken(token, self.tokenPath)
+
+    # Send the logoff message to the server. The server revokes the device's token when it logs off
     def logoff(self):
-        logoff = ("LOGOFF\t" + self.deviceName)
-        logoff = logoff.encode('ascii')
-        self.sendServerMessage(logoff)
+        self.setToken(None)
+        logoff = ["LOGOFF", self.deviceName]
+        return self.request(logoff)
 
     # Send data that is requested by the server
-    def sendData(self, dcode, length, data, client):
+    def sendData(self, dcode, length, data, client=False):
         timeStamp = int(time())
-        reply = ("DATA\t" + dcode + '\t' + self.deviceName + '\t' + str(timeStamp) + '\t' + str(length) + '\t' + data)
-        reply = reply.encode('ascii')
+        reply = ["DATA", dcode, self.deviceName, str(timeStamp), str(length), data]
         if client:
-            self.sendClientMessage(reply, self.addr)
+            self.sendClientMessage(encodeMessage(reply, ASCII), self.addr)
         else:
-            self.sendServerMessage(reply)
+            return self.request(reply)
 
     def queryDevice(self):
         timeStamp = int(time())
+        # Only the menu's query needs the local database, so it is opened the first time it is used
+        if self.conn is None:
+            self.conn = sqlite3.connect("IOT.db")
         cur = self.conn.cursor()
         sql = '''SELECT * FROM registration where active=?'''
         cur.execute(sql, (1,))
@@ -155,16 +242,16 @@ class IOTclient:
 
     def clientACK(self, addr, code, msg):
         timeStamp = int(time())
-        msg = self.remakeString(msg)
-        tempMsg = msg.encode('ascii')
-        self.h.update(tempMsg)
-        hashed = self.h.hexdigest()
+        # Device to device messages never negotiate, so their ACKs always use SHA256
+        hashed = digestMessage(msg, SHA256)
         message = ("ACK\t" + code + '\t' + self.deviceName + '\t' + str(timeStamp) + '\t' + hashed)
         messageE = message.encode('ascii')
         self.udpClient.sendto(messageE, addr)
 
     # This is a function to process the ACK message that comes from the server
     def processServerACK(self, msg):
+        if not self.interactive:
+            return
         if msg[1] == '00':
             print("Device " + msg[2] + " Registered")
         elif msg[1] == '01':
@@ -183,16 +270,26 @@ class IOTclient:
             print("Device is already registered with another MAC or IP")
         elif msg[1] == '31':
             print("Device is not registered")
+        elif msg[1] == '32':
+            print("Login refused, the passphrase did not match")
+        elif msg[1] == '33':
+            print("Device is already logged in")
         elif msg[1] == '50':
             print("Device Data received")
         elif msg[1] == '51':
             print("Device is not registered")
         elif msg[1] == '70':
             print("Device is logged on")
+        elif msg[1] == '71':
+            print("Login token refused, logging in with the passphrase")
         elif msg[1] == '80':
             print("Device id logged off")
+        elif msg[1] == '81':
+            print("Device was not logged in")
 
     def processClientACK(self, msg):
+        if not self.interactive:
+            return
         if msg[1] == '40':
             print("Status Received")
         if msg[1] == '50':
@@ -200,25 +297,40 @@ class IOTclient:
 
     # Once a message is sent, this waits for a reply
     def processServerMessage(self):
+        buffer = FrameBuffer()
         while True:
             try:
                 data = self.tcpClient.recv(1024)
-                msg = data.decode('ascii')
-                newMsg = msg.split('\t')
-                if newMsg[0] == "QUERY":
-                    self.processQuery(newMsg)
-                elif newMsg[0] == "ACK":
-                    self.processServerACK(newMsg)
-                elif newMsg[0] == "DATA":
-                    self.processServerData(newMsg)
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                for frame in buffer.feed(data):
+                    requestId, newMsg = untagMessage(decodeMessage(frame))
+                    if newMsg[0] == "QUERY":
+                        self.processQuery(newMsg)
+                    elif newMsg[0] == "ACK":
+                        self.processServerACK(newMsg)
+                        if requestId is not None:
+                            self.resolveRequest(requestId, newMsg)
+                    elif newMsg[0] == "DATA":
+                        self.processServerData(newMsg)
+                    elif newMsg[0] == HELLO:
+                        # The server lists the options from our HELLO that it accepted
+                        if BINARY in newMsg[1:]:
+                            self.codec = BINARY
+                        if BLAKE2 in newMsg[1:]:
+                            self.digest = BLAKE2
             except:
+                self.failRequests()
+                if not self.interactive:
+                    return
                 print("Connection is closed or unavailable")
                 sys.exit(1)
 
     def processClientMessage(self):
         while True:
             data, addr = self.udpClient.recvfrom(1024)
-            print("Recieved connection from: ", addr)
+            if self.interactive:
+                print("Recieved connection from: ", addr)
             #self.checkStatus(addr)
             msg = data.decode('ascii')
             newMsg = msg.split('\t')
@@ -233,8 +345,10 @@ class IOTclient:
 
     def sendServerMessage(self, msg):
         try:
-            self.tcpClient.send(msg)
+            self.tcpClient.sendall(encodeFrame(encodeMessage(msg, self.codec)))
         except:
+            if not self.interactive:
+                raise
             print("Socket has been closed or Server is offline, closing connection")
             self.tcpClient.close()
             sys.exit(1)
@@ -246,8 +360,29 @@ class IOTclient:
         try:
             self.tcpClient.connect(self.server)
         except:
+            if not self.interactive:
+                raise
             print("Server is offline")
             sys.exit(1)
+        # Ask for the binary encoding and BLAKE2b digests if wanted. Servers that do not know them keep using
+        # ASCII and SHA256
+        options = [option for option, wanted in ((BINARY, self.offerBinary), (BLAKE2, self.offerBlake2)) if wanted]
+        if options:
+            self.sendServerMessage([HELLO] + options)
+
+    # Binds, connects and starts both listeners, everything main does before showing the menu
+    def start(self):
+        self.bindClient()
+        self.serverconnect()
+        self.tcpListener = Thread(target=self.processServerMessage, daemon=True)
+        self.udpListener = Thread(target=self.processClientMessage, daemon=True)
+        self.tcpListener.start()
+        self.udpListener.start()
+
+    def close(self):
+        self.tcpClient.close()
+        self.tcpAWS.close()
+        self.udpClient.close()
 
     def remakeString(self, string):
         s = '\t'
@@ -257,17 +392,20 @@ class IOTclient:
     def processServerData(self, msg):
         if msg[1] == '02':
             self.AWS_IP = msg[2]
-            print("AWS IP and Port: %s:%s" % (self.AWS_IP, self.AWS_PORT))
+            if self.interactive:
+                print("AWS IP and Port: %s:%s" % (self.AWS_IP, self.AWS_PORT))
             self.AWS_PORT = int(msg[3])
             self.tcpAWS.connect((self.AWS_IP, self.AWS_PORT))
             msg = "REGISTER\t" + self.deviceID + "\t" + self.deviceName
             msgE = msg.encode('ascii')
 
-    def sendCloud(self):
-        data = input("Enter a message to send to the cloud: ")
+    # Sends a message to the cloud server, the menu asks for it when no message is given
+    def sendCloud(self, data=None):
+        if data is None:
+            data = input("Enter a message to send to the cloud: ")
         msg = "DATA\t" + self.deviceID + "\t" + data
         msgE = msg.encode('ascii')
-        self.tcpAWS.send(msgE)
+        self.tcpAWS.sendall(encodeFrame(msgE))
 
 
 # The main menu for the program
@@ -307,18 +445,21 @@ def MACprettyprint(mac):
 
 # Main function to run the program
 def main():
+    # Use Command Line arguments to get pertinent information
+    parser = ap.ArgumentParser()
+    parser.add_argument("-d", "--device", required=True, help="The name of the device")
+    parser.add_argument("-i", "--id", required=True, help="The deviceName for the cloud")
+    parser.add_argument("-s", "--server", required=True, help="The IP of the server")
+    parser.add_argument("-p", "--port", required=True, help="The port that the server is on")
+    args = vars(parser.parse_args())
+
     # Initialize the device with values
     mac = MACprettyprint(randomMAC())
     device = IOTclient(args["device"], args["id"], "toor", mac, int(args["port"]), args["server"])
-    device.bindClient()
-    device.serverconnect()
-    tcpListener = Thread(target=device.processServerMessage, daemon=True)
-    udpListener = Thread(target=device.processClientMessage, daemon=True)
-    tcpListener.start()
-    udpListener.start()
+    device.start()
     mainMenu(device)
-    tcpListener.join(0.1)
-    udpListener.join(0.1)
+    device.tcpListener.join(0.1)
+    device.udpListener.join(0.1)
     device.tcpClient.close()
 
 
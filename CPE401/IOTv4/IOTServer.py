@@ -7,19 +7,128 @@
 # Version: 1.0
 
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, gethostname, gethostbyname
-import sqlite3
-from time import time
+from time import time, sleep, monotonic
 from argparse import ArgumentParser
-import hashlib
-from threading import Thread
+import sqlite3
+from threading import Thread, Lock, current_thread
+from multiprocessing import Process, Queue
+from concurrent.futures import wait
 import logging
+import asyncio
+from framing import encodeFrame, FrameBuffer
+from protocol import decodeMessage, encodeMessage, tagMessage, untagMessage, ASCII, BINARY, HELLO, SHA256, BLAKE2, \
+    DIGESTS
+from storage import IOTStorage
+from dispatch import WorkerPool
+from metrics import Metrics
+from activitylog import startLogging, attachQueue
+from registry import DeviceRegistry, ConnectionRegistry, ACTIVE
+from migrate import upgradeDatabase
+from tokens import TokenSigner, isToken, loadOrCreateSecret
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = None
+
+menu = {"1": "Query Device", "2": "Worker Pool Status", "3": "Message Metrics", "0": "Close Server"}
+# Message types that get their own metrics, anything else is counted as OTHER
+MESSAGE_TYPES = ("REGISTER", "DEREGISTER", "LOGIN", "LOGOFF", "DATA", "QUERY", HELLO)
+# The fewest fields, counting the message name, each message type needs before it can be handled
+MIN_FIELDS = {"REGISTER": 4, "DEREGISTER": 2, "LOGIN": 5, "LOGOFF": 2, "DATA": 3, "QUERY": 2}
+
+
+# Raises ValueError for a message that is too short to handle, so it goes down the same path as one that
+# could not be decoded
+def checkFields(msg):
+    if not msg:
+        raise ValueError("Empty message")
+    if len(msg) < MIN_FIELDS.get(msg[0], 1):
+        raise ValueError("%s needs at least %d fields, got %d" % (msg[0], MIN_FIELDS[msg[0]], len(msg)))
+
+
+# Lets a single process hold more sockets than the default descriptor limit
+def raiseFileLimit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+# Wraps an asyncio stream so the message handlers can keep calling connect.send()
+class AsyncConnection:
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.codec = ASCII
+        self.digest = SHA256
+        self.requestId = None
+        # Cleared for an old device that does not frame its messages, its replies go out unframed too
+        self.framed = True
+
+    # Writes straight to the transport on the loop, or hands the write to the loop from other threads
+    def send(self, data):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        self.writer.close()
+
+
+# Wraps a device's socket in thread mode so it can carry the encoding the device negotiated
+class SocketConnection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.codec = ASCII
+        self.digest = SHA256
+        self.requestId = None
+        self.framed = True
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    send = sendall
+
+    def close(self):
+        self.sock.close()
+
 
-# Command line arguments for the port to start the server on
-parser = ArgumentParser()
-parser.add_argument("-p", "--port", required=True, help="The port that the server starts on")
-args = vars(parser.parse_args())
+# A registration change waiting on the group commit, and the step that replies once it is durable.
+# done is called once the reply is sent, with whether the reply failed
+class PendingWrite:
+    def __init__(self, future, callback, *args):
+        self.future = future
+        self.callback = callback
+        self.args = args
+        self.done = None
 
-menu = {"1": "Query Device", "0": "Close Server"}
+    def finish(self):
+        failed = True
+        try:
+            self.callback(self.future, *self.args)
+            failed = False
+        finally:
+            if self.done is not None:
+                self.done(failed)
 
 
 class IOTserver:
@@ -31,48 +140,130 @@ class IOTserver:
     TCP_PORT = 0
     AWS_IP = "ec2-18-222-250-95.us-east-2.compute.amazonaws.com"
     AWS_PORT = 59000
+    # The local port the cloud connection is made from, 0 lets the system pick one
+    AWS_LOCAL_PORT = 6701
     print("Server at: ", TCP_IP)
-    h = hashlib.sha256()
     addr = ''
     threads = []
     tcpListener = []
-    connectionQueue = []
-    logging.basicConfig(filename="Activity.log", filemode="a",
-                        format='%(asctime)s - %(message)s',
-                        datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
+    # Set by main once Activity.log is being written, see activitylog.py
+    logWriter = None
+    # The secret login tokens are signed with. The supervisor makes it before it starts the workers, so they all
+    # read the same one, and it is kept so tokens outlive a restart
+    TOKEN_SECRET_FILE = "ServerToken.key"
 
     # Take the command line port and give it to the server
 
-    def __init__(self, p):
+    def __init__(self, p, batchDelay=0.002, batchSize=256, poolSize=8, queueSize=1024):
         self.TCP_PORT = p
+        self.metrics = Metrics()
+        self.pool = WorkerPool(poolSize, queueSize)
+        self.db = IOTStorage('IOT.db', batchDelay=batchDelay, batchSize=batchSize, metrics=self.metrics)
+        self.registry = DeviceRegistry(self.db)
+        self.connections = ConnectionRegistry()
+        # Signs the tokens a device can log in with instead of its passphrase, see tokens.py
+        self.tokens = TokenSigner(secret=loadOrCreateSecret(self.TOKEN_SECRET_FILE))
+        self.workers = []
+        # In a worker, the query queues of the other workers, for devices connected to them
+        self.peerQueries = []
+        self.inFlight = 0
+        self.inFlightLock = Lock()
+        self.metrics.addGauge("pool", self.pool.stats)
+        self.metrics.addGauge("connections", lambda: len(self.connections))
+        self.metrics.addGauge("messages_in_flight", lambda: self.inFlight)
+
+    # Serves the metrics over HTTP on the loopback interface, see metrics.py for the paths
+    def serveMetrics(self, port):
+        self.metricsServer = self.metrics.serve("127.0.0.1", port)
+        logging.info("Metrics at http://127.0.0.1:%s/metrics", self.metricsServer.server_address[1])
 
     # Starts the server and connects to the Database
     def startServer(self):
+        self.loadRegistry(clearSessions=True)
+        self.bindServer()
+        self.connectAWS()
+
+    # Brings the database schema up to date and reads the registrations into memory.
+    # The process that owns the port clears sessions left active by a crash so those devices can log in again
+    def loadRegistry(self, clearSessions=False):
+        upgradeDatabase(self.db.path)
+        if clearSessions:
+            self.db.logoffAll().result()
+        self.registry.load()
+
+    # Binds the listening socket. Shards each bind their own socket to the same port with SO_REUSEPORT
+    def bindServer(self, reusePort=False):
+        if reusePort:
+            self.tcpServer = socket(AF_INET, SOCK_STREAM)
+            self.tcpServer.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self.tcpServer.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
         self.tcpServer.bind((self.TCP_IP, self.TCP_PORT))
-        self.tcpAWS.bind((self.TCP_IP, 6701))
-        self.tcpAWS.connect((self.AWS_IP, self.AWS_PORT))
         logging.info("Server is Online at %s:%s", self.TCP_IP, self.TCP_PORT)
+
+    def connectAWS(self):
+        self.tcpAWS.bind((self.TCP_IP, self.AWS_LOCAL_PORT))
+        self.tcpAWS.connect((self.AWS_IP, self.AWS_PORT))
         logging.info("Server connected to AWS")
 
-    # Generates the ACK message to send to the device
-    def ackMessage(self, code, deviceID, msg, connect):
+    # Starts the worker processes and keeps a queue to each one for the queries typed into the menu.
+    # Each worker also gets the other workers' queues, to pass on queries between devices on different workers.
+    # The registration database is the shared state, so the registry reads it instead of its own memory.
+    # With a metrics port, worker i serves its own metrics on the port metricsPort + 1 + i.
+    # The workers send their log lines to this process's log writer, so only one process writes and rotates the file
+    def startSupervisor(self, workers, useAsyncio, metricsPort=None):
+        if SO_REUSEPORT is None:
+            raise RuntimeError("SO_REUSEPORT is not available on this platform")
+        self.registry.shared = True
+        self.loadRegistry(clearSessions=True)
+        self.connectAWS()
+        logQueue = self.logWriter.queue if self.logWriter is not None else None
+        allQueries = [Queue() for i in range(workers)]
+        for i, queries in enumerate(allQueries):
+            workerMetrics = metricsPort + 1 + i if metricsPort is not None else None
+            peers = [other for other in allQueries if other is not queries]
+            worker = Process(target=runWorker, daemon=True,
+                             args=(self.TCP_IP, self.TCP_PORT, self.db.writer.batchDelay, self.db.writer.batchSize,
+                                   self.pool.size, self.pool.depth, useAsyncio, queries, workerMetrics,
+                                   logQueue, peers))
+            worker.start()
+            self.workers.append((worker, queries))
+        logging.info("Started %d workers on port %s", workers, self.TCP_PORT)
+
+    # Runs in each worker: sends a query on if the device is connected to this worker
+    def forwardQueries(self, queries):
+        while True:
+            deviceName, msg = queries.get()
+            connect = self.connections.get(deviceName)
+            if connect is not None:
+                self.sendMessage(msg, connect)
+
+    # Generates the ACK message to send to the device. The digest covers only the message being answered,
+    # so the device can check it against what it sent. A login's ACK also carries the device's next token
+    def ackMessage(self, code, deviceID, msg, connect, token=None):
+        started = monotonic()
         timeStamp = int(time())
-        tempMsg = msg.encode('ascii')
-        self.h.update(tempMsg)
-        hashed = self.h.hexdigest()
-        message = ("ACK\t" + code + '\t' + deviceID + '\t' + str(timeStamp) + '\t' + hashed)
-        messageE = message.encode('ascii')
-        connect.send(messageE)
+        hashed = DIGESTS[connect.digest](msg.encode('ascii'))
+        message = ["ACK", code, deviceID, str(timeStamp), hashed]
+        if token is not None:
+            message.append(token)
+        # Echo the ID of the request being answered so the device can match the ACK to it
+        if connect.requestId is not None:
+            message = tagMessage(message, connect.requestId)
+        self.sendMessage(message, connect)
+        # Every reply code is counted, so rejected registrations and logins (13, 21, 31) show up here
+        self.metrics.inc("acks_total", code=code)
+        self.metrics.observe("ack_seconds", monotonic() - started)
+
+    # Sends one message to the device, in the encoding the device negotiated, framed unless the device is too old
+    def sendMessage(self, message, connect):
+        data = encodeMessage(message, connect.codec)
+        connect.sendall(encodeFrame(data) if connect.framed else data)
 
     # Generates the query message for data requested by the server
     def queryMessage(self):
         code = "01"
         timeStamp = int(time())
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
-        sql = '''SELECT * FROM registration where active=?'''
-        cur.execute(sql, (1,))
-        devices = cur.fetchall()
+        devices = self.registry.activeDevices()
         if len(devices) > 0:
             print("Active Devices:")
             i = 0
@@ -89,69 +280,40 @@ class IOTserver:
         else:
             deviceID = "Server"
             param = devices[int(selection) - 1][1]
-            connect = self.connectionQueue[int(selection) - 1]
-            msg = ("QUERY\t" + code + "\t" + deviceID + "\t" + str(timeStamp) + "\t" + param)
-            msg = msg.encode('ascii')
-            connect.send(msg)
-            cur.close()
-            conn.close()
+            msg = ["QUERY", code, deviceID, str(timeStamp), param]
+            # The device may be connected to any worker, the one holding its connection sends the query
+            if self.workers:
+                for worker, queries in self.workers:
+                    queries.put((param, msg))
+                return
+            connect = self.connections.get(param)
+            if connect is None:
+                print(param, "is not connected to this server")
+                return
+            self.sendMessage(msg, connect)
 
     # Registers the device into the database
     def registerDevice(self, data, connect):
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
-        device = self.lookup(data[1], '', '')
-        # Check to see if the device is in the database
-        if device[0]:
-            msg = self.remakeString(data)
-            # Check to see if the IP is already attached to another device
-            # if device[1][0][4] == data[4] and device[1][0][1] != data[1]:
-            #   self.ackMessage('12', data[1], msg, self.addr)
-
-            # Check to see if the MAC address is attached to another device
-            if device[1][0][3] == data[3] and device[1][0][1] != data[1]:
-                self.ackMessage('13', data[1], msg, connect)
-
-            # Update the IP if the IP is different but the device is the same
-            # elif device[1][0][4] != data[4] and device[1][0][1] == data[1]:
-            #    sql = "UPDATE registration SET ip=? WHERE deviceName=?"
-            #    cur.execute(sql, (data[4], data[1]))
-            #    self.ackMessage('02', data[1], msg, self.addr)
-
-            # If all of these checks are passed, it is the same device trying to register
-            else:
-                self.ackMessage('01', data[1], msg, connect)
-
-        # If the device is not in the database, check to make sure the mac and IP aren't being reused
-        elif not device[0]:
-            # ip = self.lookup('', data[4], '')
-            mac = self.lookup('', '', data[3])
-            msg = self.remakeString(data)
-
-            # Checking if an ip exists in the database
-            # if ip[0]:
-            #    self.ackMessage('12', data[1], msg, self.addr)
-
-            if mac[0]:
-                self.ackMessage('13', data[1], msg, connect)
-
-            # Device is not in the database, add it to the database
-            # elif ip[0] == False and mac[0] == False:
-            elif not mac[0]:
-                logging.info('%s has registered', data[1])
-                # SQL command to add the device to the database
-                sql = ''' INSERT INTO registration(deviceName, passphrase, mac, active) 
-                             VALUES(?,?,?,?) '''
-                insertData = (data[1], data[2], data[3], 0)
-                cur.execute(sql, insertData)
-                conn.commit()
-                msgD = ("DATA\t" + '02' + "\t" + self.AWS_IP + "\t" + str(self.AWS_PORT))
-                msgE = msgD.encode('ascii')
-                connect.send(msgE)
-                msg = self.remakeString(data)
-                self.ackMessage('00', data[1], msg, connect)
-                cur.close()
-                conn.close()
+        msg = self.remakeString(data)
+        future = self.registry.registerDevice(data[1], data[2], data[3])
+        return PendingWrite(future, self.finishRegister, data, msg, connect)
+
+    def finishRegister(self, future, data, msg, connect):
+        try:
+            row = future.result()
+        except sqlite3.IntegrityError:
+            # The MAC address is attached to another device
+            self.ackMessage('13', data[1], msg, connect)
+            return
+
+        # No row means the name was already registered, so it is the same device trying to register
+        if row is None:
+            self.ackMessage('01', data[1], msg, connect)
+        else:
+            logging.info('%s has registered', data[1])
+            msgD = ["DATA", '02', self.AWS_IP, str(self.AWS_PORT)]
+            self.sendMessage(msgD, connect)
+            self.ackMessage('00', data[1], msg, connect)
 
     # Rejoins the original message back to its original form
     def remakeString(self, string):
@@ -161,172 +323,294 @@ class IOTserver:
 
     # This function removes a device from the database
     def deregisterDevice(self, data, connect):
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
-        deviceName = data[1]
-        device = self.lookup(deviceName, '', '')
-        # Check if the device is in the database
-        if device[0]:
+        msg = self.remakeString(data)
+        future = self.registry.deregisterDevice(data[1])
+        return PendingWrite(future, self.finishDeregister, data, msg, connect)
+
+    def finishDeregister(self, future, data, msg, connect):
+        if future.result() is not None:
             logging.info("%s has deregistered", data[1])
-            sql = 'DELETE FROM registration where deviceName=?'
-            cur.execute(sql, (deviceName,))
-            conn.commit()
-            msg = self.remakeString(data)
+            self.tokens.revoke(data[1])
             self.ackMessage('20', data[1], msg, connect)
-            cur.close()
-            conn.close()
 
         # Device is not in the database
-        elif not device[0]:
-            msg = self.remakeString(data)
+        else:
             self.ackMessage('21', data[1], msg, connect)
 
-    # Looks up a device name, IP, or MAC in the database
+    # Looks up a device name, IP, or MAC in the in-memory registry
     def lookup(self, deviceName, ip, mac):
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
-        # Get the number of rows in the table
-        exists = False
-
-        # Looks up the device name
+        rows = []
         if deviceName:
-            cur.execute("SELECT * FROM registration where deviceName=?", (deviceName,))
-            rows = cur.fetchall()
-
-            # If the device name does not exist the next query will be for IP
-            if not rows:
-                exists = False
-                cur.close()
-                conn.close()
-                return exists, rows
-
-            # Look for the device in the database
-            else:
-                for i in range(len(rows)):
-                    if rows[i][1] == deviceName:
-                        exists = True
-        # Looks up the IP address
+            rows = self.registry.findByName(deviceName)
         elif ip:
-            cur.execute("SELECT * FROM registration where ip=?", (ip,))
-            rows = cur.fetchall()
-
-            # If the IP does not exist, the next query will be for MAC address
-            if not rows:
-                exists = False
-                cur.close()
-                conn.close()
-                return exists, rows
-            else:
-                for i in range(len(rows)):
-                    if rows[i][4] == ip:
-                        exists = True
-        # Looks up the MAC address
+            rows = self.registry.findByIp(ip)
         elif mac:
-            cur.execute("SELECT * FROM registration where mac=?", (mac,))
-            rows = cur.fetchall()
-
-            # If the nex
-            if not rows:
-                exists = False
-                cur.close()
-                conn.close()
-                return exists, rows
-            else:
-                for i in range(len(rows)):
-                    if rows[i][3] == mac:
-                        exists = True
-
-        cur.close()
-        conn.close()
+            rows = self.registry.findByMac(mac)
+        exists = len(rows) > 0
         return exists, rows
 
     # Logs in the device
     def loginDevice(self, data, connect):
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
         deviceName = data[1]
         ip = data[3]
         port = int(data[4])
         msg = self.remakeString(data)
-        device = self.lookup(deviceName, '', '')
 
-        # Changes the status of the device to active
-        if device[0]:
-            if device[1][0][2] == data[2] and device[1][0][6] == 0:
-                logging.info("%s has logged in", deviceName)
-                sql = "UPDATE registration SET ip=?, port=?, active=? WHERE deviceName=?"
-                update = (ip, port, 1, deviceName)
-                cur.execute(sql, update)
-                conn.commit()
-                cur.close()
-                conn.close()
-                self.ackMessage('70', deviceName, msg, connect)
+        # A token from an earlier login is checked in memory and stands in for the passphrase
+        if isToken(data[2]):
+            if not self.tokens.check(deviceName, data[2]):
+                self.ackMessage('71', deviceName, msg, connect)
+                return None
+            future = self.registry.activateDevice(deviceName, ip, port)
         else:
+            # Changes the status of the device to active if the passphrase matches and it is logged off
+            future = self.registry.loginDevice(deviceName, data[2], ip, port)
+        return PendingWrite(future, self.finishLogin, deviceName, msg, connect)
+
+    # Every LOGIN is answered, so a device waiting on its ACK always hears back
+    def finishLogin(self, future, deviceName, msg, connect):
+        if future.result() is not None:
+            logging.info("%s has logged in", deviceName)
+            self.connections.add(deviceName, connect)
+            self.ackMessage('70', deviceName, msg, connect, self.tokens.issue(deviceName))
+            return
+        device = self.lookup(deviceName, '', '')
+        if not device[0]:
             self.ackMessage('31', deviceName, msg, connect)
+        elif device[1][0][ACTIVE] == 1:
+            # The device is already logged in
+            self.ackMessage('33', deviceName, msg, connect)
+        else:
+            # The passphrase did not match
+            self.ackMessage('32', deviceName, msg, connect)
 
     # Logs off the device from the server
     def logoffDevice(self, data, connect):
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
         deviceName = data[1]
         msg = self.remakeString(data)
-        device = self.lookup(deviceName, '', '')
-        if device[0]:
-            if device[1][0][6] == 1:
-                logging.info('%s has logged off', deviceName)
-                sql = "UPDATE registration SET active=? WHERE deviceName=?"
-                update = (0, deviceName)
-                cur.execute(sql, update)
-                conn.commit()
-                cur.close()
-                conn.close()
-                self.ackMessage('80', deviceName, msg, connect)
-        else:
+        future = self.registry.logoffDevice(deviceName)
+        return PendingWrite(future, self.finishLogoff, deviceName, msg, connect)
+
+    def finishLogoff(self, future, deviceName, msg, connect):
+        if future.result() is not None:
+            logging.info('%s has logged off', deviceName)
+            self.tokens.revoke(deviceName)
+            self.connections.remove(deviceName)
+            self.ackMessage('80', deviceName, msg, connect)
+        elif not self.lookup(deviceName, '', '')[0]:
             self.ackMessage('31', deviceName, msg, connect)
+        else:
+            # The device was not logged in
+            self.ackMessage('81', deviceName, msg, connect)
 
-    # Processes the message that the client sends
+    # Processes the message that the client sends.
+    # Registration changes return a PendingWrite that has to be finished once the write is committed.
+    # A connection's messages are handled one at a time, so its requestId is the one its next ACK answers.
+    # Each message is timed from here until its reply is sent, which includes the group commit for a PendingWrite
     def processMessage(self, data, connect):
-        tempData = data.decode('ascii')
-        msg = tempData.split('\t')
+        started = monotonic()
+        try:
+            connect.requestId, msg = untagMessage(decodeMessage(data))
+            checkFields(msg)
+        except ValueError:
+            self.metrics.inc("messages_malformed_total")
+            raise
+        kind = msg[0] if msg[0] in MESSAGE_TYPES else "OTHER"
+        with self.inFlightLock:
+            self.inFlight += 1
+        try:
+            pending = self.handleMessage(msg, connect)
+        except Exception:
+            self.messageDone(kind, started, True)
+            raise
+        if pending is None:
+            self.messageDone(kind, started, False)
+        else:
+            pending.done = lambda failed: self.messageDone(kind, started, failed)
+        return pending
+
+    def messageDone(self, kind, started, failed):
+        with self.inFlightLock:
+            self.inFlight -= 1
+        self.metrics.inc("messages_total", type=kind)
+        if failed:
+            self.metrics.inc("message_errors_total", type=kind)
+        self.metrics.observe("message_seconds", monotonic() - started, type=kind)
+
+    def handleMessage(self, msg, connect):
         if msg[0] == 'REGISTER':
-            self.registerDevice(msg, connect)
+            return self.registerDevice(msg, connect)
         elif msg[0] == "DEREGISTER":
-            self.deregisterDevice(msg, connect)
+            return self.deregisterDevice(msg, connect)
         elif msg[0] == "LOGIN":
-            self.loginDevice(msg, connect)
+            return self.loginDevice(msg, connect)
         elif msg[0] == "LOGOFF":
-            self.logoffDevice(msg, connect)
+            return self.logoffDevice(msg, connect)
         elif msg[0] == "DATA":
             self.processData(msg, connect)
         elif msg[0] == "QUERY":
             self.processQuery(msg, connect)
+        elif msg[0] == HELLO:
+            self.negotiate(msg, connect)
+
+    # Answers with the options from the device's HELLO that this server supports, then switches to them.
+    # Older devices never send HELLO, or leave out an option, and keep the ASCII encoding or SHA256 digests
+    def negotiate(self, msg, connect):
+        accepted = [option for option in msg[1:] if option in (BINARY, BLAKE2)]
+        if not accepted:
+            return
+        self.sendMessage([HELLO] + accepted, connect)
+        if BINARY in accepted:
+            connect.codec = BINARY
+        if BLAKE2 in accepted:
+            connect.digest = BLAKE2
 
     def processData(self, msg, connect):
         if msg[1] == '01':
             msgE = self.remakeString(msg)
             self.ackMessage("50", msg[2], msgE, connect)
 
+    # A device asks for data from another device, msg[4] names the device being queried
     def processQuery(self, msg, connect):
         if msg[1] == '01':
             self.sendData(msg)
 
+    # Passes the query on to the named device. With workers the device may be connected to another one,
+    # so the query goes to the other workers' queues and the one holding the connection sends it
     def sendData(self, msg):
-        self.lookup()
+        if len(msg) < 5:
+            return
+        target = self.connections.get(msg[4])
+        if target is not None:
+            self.sendMessage(msg, target)
+            return
+        for queries in self.peerQueries:
+            queries.put((msg[4], msg))
 
     # Listens on the port for data
     def acceptConnection(self):
+        self.pool.start()
         while True:
             self.tcpServer.listen(5)
-            (connect, (ip, port)) = self.tcpServer.accept()
-            self.connectionQueue.append(connect)
+            (sock, (ip, port)) = self.tcpServer.accept()
+            connect = SocketConnection(sock)
             newthread = Thread(target=self.recieveData, args=(connect,), daemon=True)
-            newthread.start()
+            # Added before it starts so the thread can always remove itself when the device disconnects
             self.threads.append(newthread)
+            newthread.start()
 
+    # Reads from the device and handles every complete message in what arrived
     def recieveData(self, connect):
-        while True:
-            data = connect.recv(2048)
-            self.processMessage(data, connect)
+        buffer = FrameBuffer()
+        reason = "closed by device"
+        try:
+            while True:
+                data = connect.recv(2048)
+                # An empty read means the device closed the socket
+                if not data:
+                    break
+                frames = buffer.feed(data)
+                connect.framed = buffer.framed
+                for frame in frames:
+                    # Blocks while the pool's queue is full, which stops this socket from being read
+                    pending = self.pool.submit(self.processMessage, frame, connect).result()
+                    # The next message waits until this write is durable so the replies stay in order
+                    if pending is not None:
+                        wait([pending.future])
+                        self.finishWrite(pending)
+        except (OSError, ValueError) as error:
+            reason = str(error)
+        finally:
+            self.closeConnection(connect, reason)
+            try:
+                self.threads.remove(current_thread())
+            except ValueError:
+                pass
+
+    # Sends the reply to a registration change once its batch is committed. When the batch could not be
+    # committed the device gets no ACK for it, but its connection stays open for the messages after it
+    def finishWrite(self, pending):
+        try:
+            pending.finish()
+        except sqlite3.Error as error:
+            logging.error("Registration change failed: %s", error)
+
+    # Cleans up after a connection ends: the device it belonged to is marked inactive and the socket is freed
+    def closeConnection(self, connect, reason):
+        deviceName = self.connections.drop(connect)
+        if deviceName is not None:
+            logging.info("%s disconnected: %s", deviceName, reason)
+            self.registry.logoffDevice(deviceName)
+        else:
+            logging.info("Connection closed: %s", reason)
+        try:
+            connect.close()
+        except OSError:
+            pass
+
+    # Runs the asyncio server in place of acceptConnection
+    def runAsyncServer(self):
+        raiseFileLimit()
+        self.pool.start()
+        asyncio.run(self.asyncAcceptConnection())
+
+    # Listens on the port and serves every connection from the one event loop
+    async def asyncAcceptConnection(self):
+        # Never more submissions than the queue holds, so submit never blocks the event loop
+        self.slots = asyncio.Semaphore(self.pool.depth)
+        self.tcpServer.setblocking(False)
+        server = await asyncio.start_server(self.asyncRecieveData, sock=self.tcpServer, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    # Reads data from a single device without tying up a thread
+    async def asyncRecieveData(self, reader, writer):
+        connect = AsyncConnection(asyncio.get_running_loop(), writer)
+        buffer = FrameBuffer()
+        reason = "closed by device"
+        try:
+            while True:
+                data = await reader.read(2048)
+                # An empty read means the device closed the socket
+                if not data:
+                    break
+                frames = buffer.feed(data)
+                connect.framed = buffer.framed
+                for frame in frames:
+                    # Waiting for a free slot stops this socket from being read while the pool is full
+                    async with self.slots:
+                        pending = await asyncio.wrap_future(self.pool.submit(self.processMessage, frame, connect))
+                    # Only this connection waits for the group commit, the loop keeps serving the others
+                    if pending is not None:
+                        try:
+                            await asyncio.wrap_future(pending.future)
+                        except Exception:
+                            pass
+                        self.finishWrite(pending)
+        except (OSError, ValueError) as error:
+            reason = str(error)
+        finally:
+            self.closeConnection(connect, reason)
+
+    # Prints the handler queue depth and how long messages are waiting for a worker
+    def poolStatus(self):
+        stats = self.pool.stats()
+        print("Workers: %d  Queue: %d/%d (max %d)" % (stats["workers"], stats["depth"], stats["capacity"],
+                                                      stats["maxDepth"]))
+        print("Messages: %d submitted, %d completed, %d blocked on a full queue" % (stats["submitted"],
+                                                                                   stats["completed"],
+                                                                                   stats["blocked"]))
+        print("Wait for a worker: %.3f ms average, %.3f ms max" % (stats["avgWaitMs"], stats["maxWaitMs"]))
+
+    # Prints how many of each message were handled and how long they took
+    def messageStatus(self):
+        snapshot = self.metrics.snapshot()
+        print("%-24s %9s %9s %9s" % ("message", "count", "p50 ms", "p99 ms"))
+        for key, histogram in sorted(snapshot["histograms"].items()):
+            print("%-24s %9d %9s %9s" % (key, histogram["count"], histogram["p50Ms"], histogram["p99Ms"]))
+        for key, count in sorted(snapshot["counters"].items()):
+            if key.startswith("acks_total") or "errors" in key or "malformed" in key:
+                print("%-40s %9d" % (key, count))
 
     # Menu for the server to send queries
     def menu(self):
@@ -338,19 +622,113 @@ class IOTserver:
             selection = input("Select an action:")
             if selection == '1':
                 self.queryMessage()
+            elif selection == '2':
+                self.poolStatus()
+            elif selection == '3':
+                self.messageStatus()
             elif selection == '0':
 
                 logging.info('Server is Going Offline')
+                self.db.close()
                 for t in self.threads:
                     t.join(0.1)
+                for worker, queries in self.workers:
+                    worker.terminate()
                 break
 
 
+# Entry point for one worker process: it binds the shared port itself and serves it with the normal handlers
+def runWorker(host, port, batchDelay, batchSize, poolSize, queueSize, useAsyncio, queries, metricsPort=None,
+              logQueue=None, peers=()):
+    if logQueue is not None:
+        attachQueue(logQueue)
+    server = IOTserver(port, batchDelay, batchSize, poolSize, queueSize)
+    server.TCP_IP = host
+    server.peerQueries = list(peers)
+    if metricsPort is not None:
+        server.serveMetrics(metricsPort)
+    server.registry.shared = True
+    server.loadRegistry()
+    server.bindServer(reusePort=True)
+    Thread(target=server.forwardQueries, args=(queries,), daemon=True).start()
+    if useAsyncio:
+        server.runAsyncServer()
+    else:
+        server.acceptConnection()
+
+
+# Runs until the process is stopped, for servers started by scripts with no one at the menu
+def waitForever(server):
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        logging.info('Server is Going Offline')
+        server.db.close()
+        for worker, queries in server.workers:
+            worker.terminate()
+
+
 def main():
-    server = IOTserver(int(args["port"]))
+    # Command line arguments for the port to start the server on
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--port", required=True, help="The port that the server starts on")
+    parser.add_argument("-H", "--host", help="The IP the server listens on, defaults to this host's address")
+    parser.add_argument("-a", "--asyncio", action="store_true",
+                        help="Serve every device from a single asyncio event loop")
+    parser.add_argument("--batch-ms", type=float, default=2.0,
+                        help="How long registration writes are collected before they are committed together")
+    parser.add_argument("--batch-rows", type=int, default=256,
+                        help="Most registration writes committed in one transaction")
+    parser.add_argument("--pool-size", type=int, default=8, help="Threads that run the message handlers")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="Messages that can wait for a handler before the server stops reading from devices")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="Fork this many worker processes that share the port with SO_REUSEPORT")
+    parser.add_argument("--aws-host", default=IOTserver.AWS_IP, help="The cloud server the data is sent to")
+    parser.add_argument("--aws-port", type=int, default=IOTserver.AWS_PORT, help="The cloud server's port")
+    parser.add_argument("--aws-local-port", type=int, default=IOTserver.AWS_LOCAL_PORT,
+                        help="The local port the cloud connection is made from, 0 picks any free port")
+    parser.add_argument("--log-file", default="Activity.log", help="Where the server's activity is logged")
+    parser.add_argument("--log-max-mb", type=float, default=10.0,
+                        help="Size in MB the log reaches before it is rotated")
+    parser.add_argument("--log-backups", type=int, default=5, help="How many rotated logs are kept")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve counters and latency histograms on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--no-menu", action="store_true",
+                        help="Serve until interrupted without reading the menu from stdin")
+    args = vars(parser.parse_args())
+
+    # Worker processes can only reach the log writer through a multiprocessing queue
+    logWriter = startLogging(args["log_file"], int(args["log_max_mb"] * 1024 * 1024), args["log_backups"],
+                             Queue() if args["workers"] > 0 else None)
+    server = IOTserver(int(args["port"]), args["batch_ms"] / 1000, args["batch_rows"],
+                       args["pool_size"], args["queue_size"])
+    server.logWriter = logWriter
+    if args["host"]:
+        server.TCP_IP = args["host"]
+    server.AWS_IP = args["aws_host"]
+    server.AWS_PORT = args["aws_port"]
+    server.AWS_LOCAL_PORT = args["aws_local_port"]
+    if args["metrics_port"] is not None:
+        server.serveMetrics(args["metrics_port"])
+    # With workers this process only runs the menu, the workers accept the devices
+    if args["workers"] > 0:
+        server.startSupervisor(args["workers"], args["asyncio"], args["metrics_port"])
+        if args["no_menu"]:
+            waitForever(server)
+        else:
+            server.menu()
+        return
     server.startServer()
-    tcpListener = Thread(target=server.acceptConnection, daemon=True)
+    if args["asyncio"]:
+        tcpListener = Thread(target=server.runAsyncServer, daemon=True)
+    else:
+        tcpListener = Thread(target=server.acceptConnection, daemon=True)
     tcpListener.start()
+    if args["no_menu"]:
+        waitForever(server)
+        return
     server.menu()
     tcpListener.join(0.1)
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Program: Queued logging to Activity.log for the University of Nevada, Reno CPE 401 IOT server
+# Filename: activitylog.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from logging.handlers import QueueHandler, RotatingFileHandler
+from queue import SimpleQueue
+import atexit
+import logging
+from dispatch import BatchWorker
+
+LOG_FORMAT = '%(asctime)s - %(message)s'
+DATE_FORMAT = '%d-%b-%y %H:%M:%S'
+
+
+# A rotating log file that is only flushed when the LogWriter finishes a batch,
+# instead of after every line like a normal FileHandler
+class BatchedFileHandler(RotatingFileHandler):
+    def flush(self):
+        pass
+
+    def flushBatch(self):
+        RotatingFileHandler.flush(self)
+
+
+# Puts records on the queue with as little work as possible in the thread that logged them.
+# The stock QueueHandler copies and fully formats every record; only the message and the traceback are
+# resolved here, so the record can cross to a worker's supervisor, and the writer does the formatting
+class FastQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# The only thread that touches the log file. The handlers only put records on the queue, so logging
+# never waits on the disk. Records are written in batches, flushed once flushDelay after the first
+# record of the batch or once batchSize records have been written
+class LogWriter(BatchWorker):
+    def __init__(self, handler, queue=None, batchSize=512, flushDelay=0.2):
+        BatchWorker.__init__(self, batchSize, flushDelay, queue if queue is not None else SimpleQueue())
+        self.handler = handler
+
+    def handleBatch(self, batch):
+        for record in batch:
+            self.handler.handle(record)
+        self.handler.flushBatch()
+
+    # The file is closed once the last batch is written
+    def close(self):
+        self.handler.close()
+
+
+# Sends every record from this process to the queue, replacing any handlers that were set up before
+def attachQueue(queue, level=logging.INFO):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(FastQueueHandler(queue))
+    root.setLevel(level)
+
+
+# Starts the writer for the log file and points the logging module at it. Worker processes pass the
+# returned writer's queue to attachQueue, so one process does all the writing and rotating
+def startLogging(filename="Activity.log", maxBytes=10 * 1024 * 1024, backupCount=5, queue=None):
+    handler = BatchedFileHandler(filename, mode="a", maxBytes=maxBytes, backupCount=backupCount)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+    writer = LogWriter(handler, queue)
+    attachQueue(writer.queue)
+    writer.start()
+    # Lines still queued when the program exits are written before it goes
+    atexit.register(writer.stop)
+    return writer
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Program: An end to end benchmark for the University of Nevada, Reno CPE 401 IOT servers
+# Filename: benchmark.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+# Starts IOTServer.py and a local cloudserver.py on loopback, each in its own process and working on copies of
+# the databases, then drives them with the simulated devices from loadgen, e.g.
+#   ./benchmark.py -n 200 --duration 5 --output bench.json --compare last.json
+# The results are written as JSON so runs from different commits can be compared.
+
+from concurrent.futures import wait
+from socket import socket, AF_INET, SOCK_STREAM, create_connection
+from time import monotonic, perf_counter, sleep, strftime
+import argparse as ap
+import json
+import os
+import platform
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from loadgen import SimulatedDevice, createDevices, closeDevices, runLoad
+from protocol import encodeMessage, decodeMessage, tagMessage, digestMessage, ASCII, BINARY, SHA256, BLAKE2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HOST = "127.0.0.1"
+# The messages the codec benchmark encodes and decodes, the ones a logged in device sends and gets most
+CODEC_MESSAGES = (tagMessage(["DATA", "01", "bench-1", "1551312000", "16", "x" * 16], 7),
+                  ["ACK", "50", "bench-1", "1551312000",
+                   "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"],
+                  tagMessage(["LOGIN", "bench-1", "toor", "127.0.0.1", "50000"], 8))
+# The numbers compared between runs, and whether a larger value is better
+HEADLINES = (("registration", "perSecond", True),
+             ("loginStorm", "recoverySeconds", False),
+             ("dataIngest", "throughput", True),
+             ("dataIngest", "p99Ms", False),
+             ("cloudIngest", "rowsPerSecond", True),
+             ("queryLatency", "p50Ms", False),
+             ("queryLatency", "p99Ms", False),
+             ("codecs", "binaryEncodeUs", False),
+             ("codecs", "binaryDecodeUs", False))
+
+
+# Asks the system for a port nobody is listening on
+def freePort():
+    with socket(AF_INET, SOCK_STREAM) as probe:
+        probe.bind((HOST, 0))
+        return probe.getsockname()[1]
+
+
+# One of the servers running as a child process in the benchmark's working directory
+class ServerProcess:
+    def __init__(self, name, script, port, options, workdir):
+        self.name = name
+        self.command = [sys.executable, os.path.join(HERE, script), "-p", str(port), "-H", HOST] + options
+        self.port = port
+        self.workdir = workdir
+        self.process = None
+
+    # Starts the server and returns how long it took to accept connections
+    def start(self, timeout=30.0):
+        started = monotonic()
+        log = open(os.path.join(self.workdir, self.name + ".out"), "a")
+        # Its own session, so a crash can take the worker processes down with it
+        self.process = subprocess.Popen(self.command, cwd=self.workdir, stdin=subprocess.DEVNULL,
+                                        stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        log.close()
+        while monotonic() - started < timeout:
+            if self.process.poll() is not None:
+                raise RuntimeError("%s exited with %d, see %s.out" % (self.name, self.process.returncode,
+                                                                      self.name))
+            try:
+                create_connection((HOST, self.port), timeout=1).close()
+                return monotonic() - started
+            except OSError:
+                sleep(0.02)
+        raise RuntimeError("%s did not start listening on port %d" % (self.name, self.port))
+
+    # Kills the server and its workers without letting them clean up, like a crash
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        # Workers are reaped after the supervisor, so wait until none of them is still holding the port
+        deadline = monotonic() + 10
+        while monotonic() < deadline:
+            try:
+                create_connection((HOST, self.port), timeout=1).close()
+                sleep(0.02)
+            except OSError:
+                break
+
+    # Interrupts the server so it closes its database, and kills it if it does not exit
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+
+# Times registering every device, all of them sent before any ACK is waited for
+def benchRegistration(devices):
+    started = monotonic()
+    done = wait([device.register() for device in devices], timeout=60)
+    seconds = monotonic() - started
+    failed = len(done.not_done) + sum(1 for future in done.done if future.exception() is not None)
+    return {"devices": len(devices), "failed": failed, "seconds": seconds, "perSecond": len(devices) / seconds}
+
+
+# Logs every device in at once and returns how many made it and how long the last one took
+def loginAll(devices):
+    started = monotonic()
+    done = wait([device.login() for device in devices], timeout=60)
+    seconds = monotonic() - started
+    accepted = sum(1 for future in done.done if future.exception() is None and future.result()[1] == '70')
+    return accepted, seconds
+
+
+# Crashes the server while every device is logged in, restarts it and times until every device is back
+def benchLoginStorm(server, devices, cloud):
+    server.kill()
+    for device in devices:
+        device.close()
+    restartSeconds = server.start()
+    restarted = []
+    for device in devices:
+        # Each device comes back with the token from its last login, like a device that kept it on disk
+        newDevice = SimulatedDevice(device.deviceName, device.deviceID, device.MAC, server.port, HOST, cloud)
+        newDevice.token = device.token
+        restarted.append(newDevice)
+    devices = restarted
+    started = monotonic()
+    for device in devices:
+        device.start()
+    accepted, seconds = loginAll(devices)
+    recovery = monotonic() - started
+    result = {"devices": len(devices), "loggedIn": accepted, "restartSeconds": restartSeconds,
+              "recoverySeconds": recovery, "loginSeconds": seconds}
+    return result, devices
+
+
+# Counts the rows the cloud server has written so far
+def countCloudRows(path):
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return conn.execute("SELECT count(*) FROM messagebox").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# Sends DATA to the cloud server and times until every message is written to its database
+def benchCloudIngest(devices, duration, threads, path, timeout=30.0):
+    before = countCloudRows(path)
+    started = monotonic()
+    sent = runLoad(devices, "cloud", duration, threads=threads)["cloud"]["count"]
+    rows = countCloudRows(path) - before
+    deadline = monotonic() + timeout
+    while rows < sent and monotonic() < deadline:
+        sleep(0.01)
+        rows = countCloudRows(path) - before
+    seconds = monotonic() - started
+    return {"sent": sent, "rows": rows, "seconds": seconds, "rowsPerSecond": rows / seconds}
+
+
+# Times encoding and decoding CODEC_MESSAGES with each codec, and the ACK digest of each message with each
+# digest, in microseconds per message, in this process only
+def benchCodecs(rounds=20000):
+    result = {}
+    for name, codec in (("ascii", ASCII), ("binary", BINARY)):
+        encoded = [encodeMessage(message, codec) for message in CODEC_MESSAGES]
+        started = perf_counter()
+        for _ in range(rounds):
+            for message in CODEC_MESSAGES:
+                encodeMessage(message, codec)
+        encodeSeconds = perf_counter() - started
+        started = perf_counter()
+        for _ in range(rounds):
+            for data in encoded:
+                decodeMessage(data)
+        decodeSeconds = perf_counter() - started
+        count = rounds * len(CODEC_MESSAGES)
+        result[name + "EncodeUs"] = encodeSeconds / count * 1e6
+        result[name + "DecodeUs"] = decodeSeconds / count * 1e6
+        result[name + "Bytes"] = sum(len(data) for data in encoded) / len(encoded)
+    for name, digest in (("sha256", SHA256), ("blake2", BLAKE2)):
+        started = perf_counter()
+        for _ in range(rounds):
+            for message in CODEC_MESSAGES:
+                digestMessage(message, digest)
+        result[name + "DigestUs"] = (perf_counter() - started) / (rounds * len(CODEC_MESSAGES)) * 1e6
+    return result
+
+
+# Prints how each headline number moved since an earlier run
+def compareResults(results, baseline):
+    print("%-30s %12s %12s %9s" % ("metric", "baseline", "current", "change"))
+    for group, metric, higherIsBetter in HEADLINES:
+        old = baseline.get("results", {}).get(group, {}).get(metric)
+        new = results["results"].get(group, {}).get(metric)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        better = (change >= 0) == higherIsBetter
+        print("%-30s %12.3f %12.3f %+8.1f%% %s" % (group + "." + metric, old, new, change,
+                                                   "" if abs(change) < 5 else ("better" if better else "worse")))
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Runs the servers in a scratch directory and adds the end to end results
+def runServers(args, results):
+    threading.stack_size(262144)
+    workdir = tempfile.mkdtemp(prefix="iot-bench-")
+    for name in ("IOT.db", "IOTCloud.sqlite"):
+        shutil.copy(os.path.join(HERE, name), workdir)
+    cloudPort = freePort()
+    serverOptions = ["--no-menu", "--aws-host", HOST, "--aws-port", str(cloudPort), "--aws-local-port", "0"]
+    if args.asyncio:
+        serverOptions.append("-a")
+    if args.workers:
+        serverOptions += ["-w", str(args.workers)]
+    cloudServer = ServerProcess("cloudserver", "cloudserver.py", cloudPort, [], workdir)
+    server = ServerProcess("IOTServer", "IOTServer.py", freePort(), serverOptions, workdir)
+    cloud = (HOST, cloudPort)
+    devices = []
+    try:
+        cloudServer.start()
+        server.start()
+        devices = createDevices(HOST, server.port, args.devices, cloud, prefix="bench")
+        results["registration"] = benchRegistration(devices)
+        print("Registration: %(perSecond).1f devices/s" % results["registration"])
+        loginAll(devices)
+        results["dataIngest"] = runLoad(devices, "data", args.duration, args.window, threads=args.threads)["data"]
+        print("DATA ingest: %(throughput).1f messages/s, p99 %(p99Ms).3f ms" % results["dataIngest"])
+        results["queryLatency"] = runLoad(devices, "query", args.duration, threads=args.threads)["query"]
+        print("Query round trip: p50 %(p50Ms).3f ms, p99 %(p99Ms).3f ms" % results["queryLatency"])
+        results["cloudIngest"] = benchCloudIngest(devices, args.duration, args.threads,
+                                                  os.path.join(workdir, "IOTCloud.sqlite"))
+        print("Cloud ingest: %(rowsPerSecond).1f rows/s" % results["cloudIngest"])
+        results["loginStorm"], devices = benchLoginStorm(server, devices, cloud)
+        print("Login storm: %(loggedIn)d of %(devices)d devices back after %(recoverySeconds).2f s"
+              % results["loginStorm"])
+    finally:
+        closeDevices(devices)
+        server.stop()
+        cloudServer.stop()
+        if args.keep:
+            print("Logs and databases kept in", workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = ap.ArgumentParser()
+    parser.add_argument("-n", "--devices", type=int, default=200, help="How many devices to simulate")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds each throughput test runs for")
+    parser.add_argument("--window", type=int, default=4, help="DATA requests each device keeps in flight")
+    parser.add_argument("--threads", type=int, default=8, help="Threads that send the requests")
+    parser.add_argument("-a", "--asyncio", action="store_true", help="Run the server with its asyncio loop")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="Worker processes for the server")
+    parser.add_argument("--output", default="benchmark.json", help="Where the JSON results are written")
+    parser.add_argument("--compare", help="Results from an earlier run to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory with the logs")
+    parser.add_argument("--codecs-only", action="store_true", help="Only time the message encodings")
+    args = parser.parse_args()
+
+    results = {"codecs": benchCodecs()}
+    print("Codecs: ASCII %(asciiEncodeUs).2f us to encode, %(asciiDecodeUs).2f us to decode, %(asciiBytes).0f bytes; "
+          "BIN1 %(binaryEncodeUs).2f us, %(binaryDecodeUs).2f us, %(binaryBytes).0f bytes" % results["codecs"])
+    print("Digests: SHA256 %(sha256DigestUs).2f us, BLAKE2B %(blake2DigestUs).2f us" % results["codecs"])
+    if not args.codecs_only:
+        runServers(args, results)
+    report = {"commit": gitCommit(), "date": strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "config": {"devices": args.devices, "duration": args.duration, "window": args.window,
+                         "threads": args.threads, "asyncio": args.asyncio, "workers": args.workers},
+              "results": results}
+    with open(args.output, "w") as out:
+        json.dump(report, out, indent=2)
+    print("Results written to", args.output)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compareResults(report, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,90 @@
 #!/usr/bin/env python3
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, gethostname, gethostbyname
 import sqlite3
-from time import time
 from argparse import ArgumentParser
-import hashlib
-from threading import Thread
-import logging
+from threading import Thread, current_thread
+from itertools import groupby
+from time import monotonic, sleep
+from framing import FrameBuffer
+from metrics import Metrics
+from dispatch import BatchWorker
 
-# Command line arguments for the port to start the server on
-parser = ArgumentParser()
-parser.add_argument("-p", "--port", required=True, help="The port that the server starts on")
-args = vars(parser.parse_args())
+REGISTER_SQL = '''INSERT INTO devicelist (deviceID, deviceName) VALUES(?,?)
+                  ON CONFLICT(deviceID) DO UPDATE SET deviceName=excluded.deviceName'''
+DATA_SQL = '''INSERT INTO messagebox (deviceID, message) VALUES (?,?)'''
+
+
+# Collects the rows from every connection and writes them with executemany, one transaction per flush.
+# A flush that finds the database busy is retried, waiting twice as long each time, before its rows are dropped
+class DataIngest(BatchWorker):
+    def __init__(self, path, flushSize=5000, flushDelay=0.05, metrics=None, retries=5, retryDelay=0.1):
+        BatchWorker.__init__(self, flushSize, flushDelay)
+        self.path = path
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.conn = None
+
+    def add(self, sql, row):
+        self.queue.put((sql, row, monotonic()))
+
+    def open(self):
+        # Waits up to 30 seconds for another writer's lock before a flush counts as busy
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    def handleBatch(self, batch):
+        self.write(self.conn, batch)
+
+    def write(self, conn, batch):
+        started = monotonic()
+        written = len(batch)
+        for attempt in range(self.retries + 1):
+            try:
+                self.flush(conn, batch)
+                break
+            except sqlite3.OperationalError as error:
+                # The database is locked or busy, which passes, so the same rows are tried again
+                if attempt == self.retries:
+                    self.metrics.inc("ingest_dropped_total", len(batch))
+                    print("Dropped %d messages after %d tries: %s" % (len(batch), attempt + 1, error))
+                    return
+                self.metrics.inc("ingest_retries_total")
+                sleep(self.retryDelay * 2 ** attempt)
+            except sqlite3.Error:
+                # A row the database refuses fails the whole executemany, so only the rows that fail are dropped
+                written = self.flushRows(conn, batch)
+                break
+        flushed = monotonic()
+        self.metrics.observe("ingest_flush_seconds", flushed - started)
+        # The first row in a flush waited the longest, from arriving until it was written
+        self.metrics.observe("ingest_wait_seconds", flushed - batch[0][2])
+        self.metrics.inc("ingest_flushes_total")
+        self.metrics.inc("ingest_rows_total", written)
+
+    def flush(self, conn, batch):
+        with conn:
+            # Rows are grouped by statement in arrival order, so a REGISTER is still written before its DATA
+            for sql, rows in groupby(batch, key=lambda item: item[0]):
+                conn.executemany(sql, [row for _, row, _ in rows])
+
+    # Writes the rows one transaction each and returns how many were written
+    def flushRows(self, conn, batch):
+        written = 0
+        for sql, row, queued in batch:
+            try:
+                with conn:
+                    conn.execute(sql, row)
+                written += 1
+            except sqlite3.Error as error:
+                self.metrics.inc("ingest_dropped_total")
+                print("Dropped a message: %s" % error)
+        return written
 
 
 class IOTCloudServer:
@@ -24,11 +98,21 @@ class IOTCloudServer:
 
     print("Server at: ", TCP_IP)
 
-    def __init__(self, p):
+    def __init__(self, p, flushSize=5000, flushDelay=0.05):
         self.TCP_PORT = p
+        self.metrics = Metrics()
+        self.ingest = DataIngest('IOTCloud.sqlite', flushSize, flushDelay, self.metrics)
+        self.metrics.addGauge("ingest_queue_depth", self.ingest.queue.qsize)
+        self.metrics.addGauge("connections", lambda: len(self.connectionQueue))
+
+    # Serves the metrics over HTTP on the loopback interface, see metrics.py for the paths
+    def serveMetrics(self, port):
+        self.metricsServer = self.metrics.serve("127.0.0.1", port)
+        print("Metrics at http://127.0.0.1:%s/metrics" % self.metricsServer.server_address[1])
 
     def startServer(self):
         self.tcpServer.bind((self.TCP_IP, self.TCP_PORT))
+        self.ingest.start()
 
     def acceptConnection(self):
         while True:
@@ -37,41 +121,79 @@ class IOTCloudServer:
             print("Connection from: %s:%s" % (ip, port))
             self.connectionQueue.append(connect)
             newthread = Thread(target=self.recieveData, args=(connect,), daemon=True)
-            newthread.start()
             self.threads.append(newthread)
+            newthread.start()
 
     def recieveData(self, connect):
-        while True:
-            data = connect.recv(2048)
-            tempData = data.decode('ascii')
-            msg = tempData.split('\t')
-            self.processData(msg, connect)
+        buffer = FrameBuffer()
+        reason = "closed by device"
+        try:
+            while True:
+                data = connect.recv(2048)
+                # An empty read means the device closed the socket
+                if not data:
+                    break
+                for frame in buffer.feed(data):
+                    tempData = frame.decode('ascii')
+                    msg = tempData.split('\t')
+                    self.processData(msg)
+        except (OSError, ValueError) as error:
+            reason = str(error)
+        finally:
+            self.closeConnection(connect, reason)
+
+    # Frees the socket and the thread that served it once the device is gone
+    def closeConnection(self, connect, reason):
+        print("Connection closed: %s" % reason)
+        try:
+            self.connectionQueue.remove(connect)
+        except ValueError:
+            pass
+        try:
+            self.threads.remove(current_thread())
+        except ValueError:
+            pass
+        try:
+            connect.close()
+        except OSError:
+            pass
 
+    # Hands the message to the ingest thread, which writes it with the next flush
     def processData(self, msg):
-        conn = sqlite3.connect('IOTCloud.sqlite')
-        cur = conn.cursor()
+        self.metrics.inc("messages_total", type=msg[0] if msg[0] in ('REGISTER', 'DATA') else "OTHER")
         if msg[0] == 'REGISTER':
             deviceID = msg[1]
             deviceName = msg[2]
-            sql = '''INSERT INTO devicelist (deviceID, deviceName) VALUES(?,?)'''
-            data = (deviceID, deviceName)
-            cur.execute(sql, data)
-            conn.commit()
+            self.ingest.add(REGISTER_SQL, (deviceID, deviceName))
         if msg[0] == 'DATA':
             deviceID = msg[1]
-            sqlmsg = '''INSERT INTO messagebox (deviceID, message) VALUES (?,?)'''
-            msg = (deviceID, msg[2])
-            server = self.connectionQueue[0]
-
-            cur.execute(sqlmsg, msg)
-            conn.commit()
-        conn.close()
+            self.ingest.add(DATA_SQL, (deviceID, msg[2]))
 
 
 def main():
-    server = IOTCloudServer(int(args['port']))
+    # Command line arguments for the port to start the server on
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--port", required=True, help="The port that the server starts on")
+    parser.add_argument("-H", "--host", help="The IP the server listens on, defaults to this host's address")
+    parser.add_argument("--flush-rows", type=int, default=5000, help="Most messages written in one transaction")
+    parser.add_argument("--flush-ms", type=float, default=50.0,
+                        help="Longest a message waits in memory before it is written")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve counters and latency histograms on http://127.0.0.1:PORT/metrics")
+    args = vars(parser.parse_args())
+
+    server = IOTCloudServer(int(args['port']), args['flush_rows'], args['flush_ms'] / 1000)
+    if args['host']:
+        server.TCP_IP = args['host']
+    if args['metrics_port'] is not None:
+        server.serveMetrics(args['metrics_port'])
     server.startServer()
-    server.acceptConnection()
+    try:
+        server.acceptConnection()
+    except KeyboardInterrupt:
+        print("Cloud server is going offline")
+        # Rows still waiting for a flush are written before the process exits
+        server.ingest.stop()
     #tcpListener = Thread(target=server.acceptConnection, daemon=True)
     #tcpListener.start()
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Program: Bounded worker pool and batching threads for the University of Nevada, Reno CPE 401 IOT server
+# Filename: dispatch.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from threading import Thread, Lock
+from queue import Queue, Empty
+from concurrent.futures import Future
+from time import monotonic
+
+
+# A fixed number of threads that run the message handlers, fed by a queue with a fixed size.
+# When the queue is full submit blocks, so the connection that is submitting stops reading from its socket.
+class WorkerPool:
+    def __init__(self, size=8, depth=1024):
+        self.size = size
+        self.depth = depth
+        self.queue = Queue(maxsize=depth)
+        self.threads = []
+        self.lock = Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.blocked = 0
+        self.maxDepth = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def start(self):
+        while len(self.threads) < self.size:
+            worker = Thread(target=self.run, daemon=True)
+            worker.start()
+            self.threads.append(worker)
+
+    # Queues fn(*args) and returns a Future for its result. Blocks while the queue is full
+    def submit(self, fn, *args):
+        future = Future()
+        if self.queue.full():
+            with self.lock:
+                self.blocked += 1
+        self.queue.put((monotonic(), future, fn, args))
+        depth = self.queue.qsize()
+        with self.lock:
+            self.submitted += 1
+            if depth > self.maxDepth:
+                self.maxDepth = depth
+        return future
+
+    def run(self):
+        while True:
+            queued, future, fn, args = self.queue.get()
+            waited = monotonic() - queued
+            with self.lock:
+                self.totalWait += waited
+                if waited > self.maxWait:
+                    self.maxWait = waited
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as error:
+                    future.set_exception(error)
+            with self.lock:
+                self.completed += 1
+
+    # Queue depth and how long messages waited for a worker, wait times are in milliseconds
+    def stats(self):
+        with self.lock:
+            started = self.submitted - self.queue.qsize()
+            return {"workers": self.size,
+                    "depth": self.queue.qsize(),
+                    "capacity": self.depth,
+                    "maxDepth": self.maxDepth,
+                    "submitted": self.submitted,
+                    "completed": self.completed,
+                    "blocked": self.blocked,
+                    "avgWaitMs": self.totalWait * 1000 / started if started > 0 else 0.0,
+                    "maxWaitMs": self.maxWait * 1000}
+
+
+# One thread that takes items off a queue and handles them in batches. A batch starts with the first item to
+# arrive and takes whatever else comes within batchDelay seconds, up to batchSize items. stop() queues None,
+# so everything queued before it is still handled. Subclasses handle each batch in handleBatch, and can set up
+# and tear down what the thread needs in open and close, which run on the thread itself
+class BatchWorker:
+    def __init__(self, batchSize, batchDelay, queue=None):
+        self.batchSize = batchSize
+        self.batchDelay = batchDelay
+        self.queue = queue if queue is not None else Queue()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # Handles whatever is still queued and stops the thread
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    # Waits for the first item, then keeps collecting until the batch is full or the delay runs out
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = monotonic() + self.batchDelay
+        while batch[-1] is not None and len(batch) < self.batchSize:
+            remaining = deadline - monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        self.open()
+        running = True
+        while running:
+            batch = self.collect()
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            if batch:
+                self.handleBatch(batch)
+        self.close()
+
+    def open(self):
+        pass
+
+    def handleBatch(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        pass
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Program: Message framing for the University of Nevada, Reno CPE 401 IOT protocol
+# Filename: framing.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from struct import Struct
+
+# Every message on a TCP stream is sent as a 4 byte big-endian length followed by the message.
+# Devices from before framing send each message in one write with no length in front. Their messages start with
+# a capital letter, while a frame's first byte is always 0 because no frame is 16 MiB or more, so the first byte
+# a connection sends tells the two apart
+frameHeader = Struct('!I')
+# Largest message a peer is allowed to send, anything bigger means the stream is corrupt
+MAX_FRAME = 1 << 20
+
+
+# Puts the length prefix in front of an encoded message
+def encodeFrame(message):
+    return frameHeader.pack(len(message)) + message
+
+
+# Holds the bytes read from one connection until whole messages can be pulled out of them.
+# framed is None until the first byte arrives, then False for an old device that sends unframed messages
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.framed = None
+
+    # Adds newly received bytes and returns every message that is now complete.
+    # For an unframed device, each read is taken as one message, the way the servers read before framing
+    def feed(self, data):
+        if self.framed is None and data:
+            self.framed = data[0] == 0
+        if self.framed is False:
+            return [bytes(data)] if data else []
+        self.buffer += data
+        frames = []
+        offset = 0
+        size = len(self.buffer)
+        while size - offset >= frameHeader.size:
+            (length,) = frameHeader.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME:
+                raise ValueError("Frame of %d bytes is larger than the %d byte limit" % (length, MAX_FRAME))
+            end = offset + frameHeader.size + length
+            # The rest of this message has not arrived yet
+            if end > size:
+                break
+            frames.append(bytes(self.buffer[offset + frameHeader.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return frames
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Program: A load generator for the University of Nevada, Reno CPE 401 IOT server
+# Filename: loadgen.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+# Simulates many devices from one process to find where the server saturates, e.g.
+#   ./loadgen.py -s 127.0.0.1 -p 6700 -n 500 --duration 30 --mix data=8,query=1,relogin=1
+# Every device has its own sockets and a random MAC, registers and logs in, then the driver threads keep
+# up to --window requests in flight per device until the time runs out.
+
+from collections import deque
+from concurrent.futures import Future, wait
+from itertools import cycle
+from threading import Thread, Lock
+from time import monotonic, time
+import argparse as ap
+import json
+import os
+import random
+import threading
+from framing import encodeFrame
+from IOTClient import IOTclient, randomMAC, MACprettyprint
+
+OPERATIONS = ("register", "relogin", "data", "query", "cloud")
+PERCENTILES = (("p50", 0.50), ("p99", 0.99), ("p999", 0.999))
+
+
+# A device with no menu. It never asks the server for the cloud's address and answers a QUERY by timing it.
+# Its login token is only kept in memory
+class SimulatedDevice(IOTclient):
+    TOKEN_DIR = None
+
+    def __init__(self, d, id, m, p, s, cloud=None):
+        IOTclient.__init__(self, d, id, "toor", m, p, s, interactive=False)
+        self.cloud = cloud
+        self.queries = deque()
+        self.queryLock = Lock()
+
+    # Only the TCP reader is started, the load never goes device to device over UDP
+    def start(self):
+        self.bindClient()
+        self.serverconnect()
+        self.tcpListener = Thread(target=self.processServerMessage, daemon=True)
+        self.tcpListener.start()
+        if self.cloud is not None:
+            self.tcpAWS.connect(self.cloud)
+            self.sendCloudRegister()
+
+    def sendCloudRegister(self):
+        msg = "REGISTER\t" + self.deviceID + "\t" + self.deviceName
+        self.tcpAWS.sendall(encodeFrame(msg.encode('ascii')))
+
+    # The cloud address comes from the command line instead
+    def processServerData(self, msg):
+        pass
+
+    # Logs off and back in, the server handles both in order so the login's ACK answers the pair
+    def relogin(self):
+        self.logoff()
+        return self.login()
+
+    # Asks the server to query this device. It comes back through the server's relay, so the time until it
+    # arrives is the query's round trip
+    def query(self):
+        timeStamp = int(time())
+        future = Future()
+        with self.queryLock:
+            self.queries.append(future)
+            self.sendServerMessage(["QUERY", "01", self.deviceName, str(timeStamp), self.deviceName])
+        return future
+
+    # Queries from one connection are relayed in order, so each one answers the oldest still waiting
+    def processQuery(self, msg):
+        with self.queryLock:
+            future = self.queries.popleft() if self.queries else None
+        if future is not None:
+            future.set_result(msg)
+
+    def failRequests(self):
+        IOTclient.failRequests(self)
+        with self.queryLock:
+            waiting = list(self.queries)
+            self.queries.clear()
+        for future in waiting:
+            future.set_exception(ConnectionError("Connection to the server closed"))
+
+    # Nothing answers cloud messages, so the future is done once the payload is written
+    def sendCloudData(self, data):
+        future = Future()
+        try:
+            self.sendCloud(data)
+            future.set_result(None)
+        except OSError as error:
+            future.set_exception(error)
+        return future
+
+
+# Collects how long every operation took. Results that arrive after finish() are ignored
+class Recorder:
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = Lock()
+        self.closed = False
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.errors = {op: 0 for op in OPERATIONS}
+        self.timeouts = {op: 0 for op in OPERATIONS}
+
+    # Times the future from now until it is done
+    def record(self, op, future):
+        start = monotonic()
+        future.add_done_callback(lambda done: self.complete(op, start, done))
+
+    def complete(self, op, start, future):
+        latency = monotonic() - start
+        with self.lock:
+            if self.closed:
+                return
+            if future.exception() is not None:
+                self.errors[op] += 1
+            elif latency > self.timeout:
+                self.timeouts[op] += 1
+            else:
+                self.latencies[op].append(latency)
+
+    # Anything still waiting at the end is counted as timed out
+    def finish(self, outstanding):
+        with self.lock:
+            for op, future in outstanding:
+                if not future.done():
+                    self.timeouts[op] += 1
+            self.closed = True
+
+    def results(self, elapsed):
+        ops = {}
+        for op in OPERATIONS:
+            latencies = sorted(self.latencies[op])
+            count = len(latencies)
+            if count == 0 and self.errors[op] == 0 and self.timeouts[op] == 0:
+                continue
+            stats = {"count": count, "errors": self.errors[op], "timeouts": self.timeouts[op],
+                     "throughput": count / elapsed if elapsed > 0 else 0.0}
+            for name, q in PERCENTILES:
+                stats[name + "Ms"] = latencies[min(count - 1, int(q * count))] * 1000 if count else None
+            ops[op] = stats
+        return ops
+
+
+# Turns "data=8,query=1" into operation names and weights
+def parseMix(text):
+    names = []
+    weights = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("Unknown operation %r, choose from %s" % (name, ", ".join(OPERATIONS)))
+        names.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    return names, weights
+
+
+# Creates and connects the devices, each with a name unique to this process and a random MAC
+def createDevices(server, port, count, cloud=None, prefix="load"):
+    devices = []
+    for i in range(count):
+        device = SimulatedDevice("%s-%d-%d" % (prefix, os.getpid(), i), str(i), MACprettyprint(randomMAC()),
+                                 port, server, cloud)
+        device.start()
+        devices.append(device)
+    return devices
+
+
+# Creates, connects, registers and logs in every device. Registrations are pipelined across all devices
+def connectDevices(server, port, count, cloud=None, prefix="load"):
+    devices = createDevices(server, port, count, cloud, prefix)
+    wait([device.register() for device in devices], timeout=30)
+    logins = wait([device.login() for device in devices], timeout=30)
+    if logins.not_done:
+        raise RuntimeError("%d devices did not log in" % len(logins.not_done))
+    return devices
+
+
+# Logs off and removes every device so repeated runs do not fill the database
+def closeDevices(devices):
+    futures = []
+    for device in devices:
+        try:
+            device.logoff()
+            futures.append(device.deregister())
+        except OSError:
+            pass
+    wait(futures, timeout=10)
+    for device in devices:
+        device.close()
+
+
+# One driver thread per group of devices. Each keeps a device's oldest request until it is answered
+# or times out, so no device ever has more than window requests in flight
+def drive(devices, names, weights, window, recorder, deadline, outstanding):
+    inflight = {device: deque() for device in devices}
+    payload = "x" * 16
+    for device in cycle(devices):
+        if monotonic() >= deadline:
+            break
+        waiting = inflight[device]
+        if len(waiting) >= window:
+            op, future = waiting.popleft()
+            wait([future], timeout=recorder.timeout)
+        op = random.choices(names, weights)[0]
+        try:
+            if op == "register":
+                future = device.register()
+            elif op == "relogin":
+                future = device.relogin()
+            elif op == "data":
+                future = device.sendData("01", len(payload), payload)
+            elif op == "query":
+                future = device.query()
+            else:
+                future = device.sendCloudData(payload)
+        except OSError as error:
+            future = Future()
+            future.set_exception(error)
+        recorder.record(op, future)
+        waiting.append((op, future))
+    for waiting in inflight.values():
+        outstanding.extend(waiting)
+
+
+# Runs the mix against connected devices for duration seconds and returns the results
+def runLoad(devices, mix, duration, window=1, timeout=5.0, threads=8):
+    names, weights = parseMix(mix)
+    if "cloud" in names and any(device.cloud is None for device in devices):
+        raise ValueError("The cloud operation needs the cloud server's address")
+    recorder = Recorder(timeout)
+    outstanding = []
+    groups = [devices[i::threads] for i in range(min(threads, len(devices)))]
+    start = monotonic()
+    deadline = start + duration
+    drivers = [Thread(target=drive, args=(group, names, weights, window, recorder, deadline, outstanding),
+                      daemon=True) for group in groups]
+    for driver in drivers:
+        driver.start()
+    for driver in drivers:
+        driver.join()
+    elapsed = monotonic() - start
+    # Requests still in flight get until the timeout to finish
+    wait([future for _, future in outstanding], timeout=timeout)
+    recorder.finish(outstanding)
+    return recorder.results(elapsed)
+
+
+def printResults(ops):
+    print("%-10s %9s %7s %8s %10s %9s %9s %9s" % ("operation", "count", "errors", "timeouts", "ops/s",
+                                               "p50 ms", "p99 ms", "p999 ms"))
+    for op, stats in ops.items():
+        latencies = ["%9.3f" % stats[name + "Ms"] if stats[name + "Ms"] is not None else "%9s" % "-"
+                     for name, _ in PERCENTILES]
+        print("%-10s %9d %7d %8d %10.1f %s" % (op, stats["count"], stats["errors"], stats["timeouts"],
+                                               stats["throughput"], " ".join(latencies)))
+
+
+def main():
+    parser = ap.ArgumentParser()
+    parser.add_argument("-s", "--server", required=True, help="The IP of the server")
+    parser.add_argument("-p", "--port", type=int, required=True, help="The port that the server is on")
+    parser.add_argument("-n", "--devices", type=int, default=100, help="How many devices to simulate")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the mix for")
+    parser.add_argument("--mix", default="data=8,query=1,relogin=1",
+                        help="Weighted operations out of %s, e.g. data=8,query=1" % ", ".join(OPERATIONS))
+    parser.add_argument("--window", type=int, default=1, help="Requests each device keeps in flight")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Seconds before a request counts as lost")
+    parser.add_argument("--threads", type=int, default=8, help="Threads that send the requests")
+    parser.add_argument("--cloud", help="host:port of the cloud server, needed for the cloud operation")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    cloud = None
+    if args.cloud:
+        host, _, port = args.cloud.rpartition(':')
+        cloud = (host, int(port))
+    # Every device has a reader thread, small stacks keep thousands of them cheap
+    threading.stack_size(262144)
+    setupStart = monotonic()
+    devices = connectDevices(args.server, args.port, args.devices, cloud)
+    setup = monotonic() - setupStart
+    print("%d devices registered and logged in after %.2f s" % (len(devices), setup))
+    try:
+        ops = runLoad(devices, args.mix, args.duration, args.window, args.timeout, args.threads)
+    finally:
+        closeDevices(devices)
+    printResults(ops)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump({"devices": args.devices, "duration": args.duration, "mix": args.mix,
+                       "window": args.window, "setupSeconds": setup, "operations": ops}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# Program: Counters, latency histograms and a metrics endpoint for the University of Nevada, Reno CPE 401 IOT servers
+# Filename: metrics.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from bisect import bisect_left
+from time import monotonic
+import json
+
+# Upper bounds of the latency buckets in seconds, from 50 microseconds to 10 seconds
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# Counts how many observations fell into each latency bucket, the last bucket holds everything slower
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Estimates a percentile as the upper bound of the bucket it falls in
+    def percentile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+# Times a block of code into a histogram, e.g.
+#   with metrics.timer("sqlite_read_seconds", query="name"):
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, kind, error, trace):
+        self.metrics.observe(self.name, monotonic() - self.started, **self.labels)
+        return False
+
+
+# Every counter and histogram for one server process, each kept per set of labels.
+# Gauges are read from a function when the metrics are served, so nothing has to keep them up to date
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    # fn returns a number, or a dict that becomes one gauge per key, e.g. the worker pool's stats
+    def addGauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def readGauges(self):
+        values = {}
+        for name, fn in self.gauges.items():
+            value = fn()
+            if isinstance(value, dict):
+                for key, number in value.items():
+                    values["%s_%s" % (name, key)] = number
+            else:
+                values[name] = value
+        return values
+
+    # Everything as a dict, the histograms with their p50 and p99 in milliseconds
+    def snapshot(self):
+        with self.lock:
+            counters = {formatKey(key): value for key, value in self.counters.items()}
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                histograms[formatKey(key)] = {"count": histogram.count, "sum": histogram.sum,
+                                              "p50Ms": toMs(histogram.percentile(0.50)),
+                                              "p99Ms": toMs(histogram.percentile(0.99)),
+                                              "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"],
+                                                                  histogram.counts))}
+        return {"counters": counters, "histograms": histograms, "gauges": self.readGauges()}
+
+    # Everything in the Prometheus text format
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(h.counts), h.count, h.sum) for key, h in sorted(self.histograms.items())]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            lines.append("%s %s" % (formatKey((name, labels)), value))
+        for (name, labels), counts, count, total in histograms:
+            if name not in typed:
+                lines.append("# TYPE %s histogram" % name)
+                typed.add(name)
+            seen = 0
+            for bound, bucketCount in zip([str(b) for b in BUCKETS] + ["+Inf"], counts):
+                seen += bucketCount
+                lines.append("%s %d" % (formatKey((name + "_bucket", labels + (("le", bound),))), seen))
+            lines.append("%s %r" % (formatKey((name + "_sum", labels)), total))
+            lines.append("%s %d" % (formatKey((name + "_count", labels)), count))
+        for name, value in sorted(self.readGauges().items()):
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    # Serves /metrics in the Prometheus text format and /metrics.json from a background thread
+    def serve(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.render().encode()
+                    kind = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode()
+                    kind = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a line each on the console
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def formatKey(key):
+    name, labels = key
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (label, value) for label, value in labels))
+
+
+def toMs(seconds):
+    return seconds * 1000 if seconds is not None else None
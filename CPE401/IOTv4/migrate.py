@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Program: Schema migrations for the University of Nevada, Reno CPE 401 IOT registration database
+# Filename: migrate.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+import os
+import sys
+import ast
+import base64
+import sqlite3
+from argparse import ArgumentParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# The registration databases that are upgraded when no paths are given
+DATABASES = [os.path.join(here, '..', 'IOTv2', 'IOT.db'),
+             os.path.join(here, '..', 'IOTv3', 'IOT.db'),
+             os.path.join(here, 'IOT.db'),
+             os.path.join(here, 'sierra', 'IOT.db'),
+             os.path.join(here, 'seqouia', 'IOT.db')]
+
+
+# Turns one PEM block into the DER bytes it wraps
+def pemToDer(pem):
+    lines = pem.strip().splitlines()
+    if len(lines) < 2 or not lines[0].startswith(b'-----BEGIN ') or not lines[-1].startswith(b'-----END '):
+        raise ValueError("Not a PEM block")
+    return base64.b64decode(b''.join(lines[1:-1]), validate=True)
+
+
+# The sierra server used to save each device's key as str() of its PEM bytes, e.g. "b'-----BEGIN PUBLIC KEY-----..."
+# and now reads and writes DER, so those rows are read back into the PEM bytes and converted.
+# A row that cannot be read is left for the server to treat as missing. Databases without a Keys table are skipped
+def convertKeys(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='Keys'").fetchone() is None:
+        return
+    rows = conn.execute("SELECT deviceid, publicKey FROM Keys WHERE typeof(publicKey) = 'text'").fetchall()
+    for deviceId, text in rows:
+        try:
+            pem = text.encode('ascii') if text.startswith('-----') else ast.literal_eval(text)
+            if not isinstance(pem, bytes):
+                continue
+            der = pemToDer(pem)
+        except (ValueError, SyntaxError):
+            continue
+        conn.execute("UPDATE Keys SET publicKey=? WHERE deviceid=?", (der, deviceId))
+
+
+# Each entry upgrades the schema by one version, PRAGMA user_version records how many have run.
+# An entry is a list of SQL statements, or a function that is given the connection
+MIGRATIONS = [
+    # 1: Index every column the server filters registration on
+    ['''CREATE UNIQUE INDEX IF NOT EXISTS registration_deviceName_uindex ON registration (deviceName)''',
+     '''CREATE UNIQUE INDEX IF NOT EXISTS registration_mac_uindex ON registration (mac)''',
+     '''CREATE INDEX IF NOT EXISTS registration_ip_index ON registration (ip)''',
+     '''CREATE INDEX IF NOT EXISTS registration_active_index ON registration (deviceName) WHERE active = 1'''],
+    # 2: Store sierra's device keys as DER
+    convertKeys,
+]
+
+
+# Raised when the rows in a database stop a migration from being applied
+class MigrationError(Exception):
+    pass
+
+
+# Rows sharing a device name or MAC would make the unique indexes fail, so report them first
+def findDuplicates(conn):
+    duplicates = []
+    for column in ('deviceName', 'mac'):
+        sql = 'SELECT %s, COUNT(*) FROM registration GROUP BY %s HAVING COUNT(*) > 1' % (column, column)
+        for value, count in conn.execute(sql):
+            duplicates.append("%s %s is used by %d devices" % (column, value, count))
+    return duplicates
+
+
+# Brings one database up to the newest schema version and returns the (old, new) versions
+def upgradeDatabase(path):
+    if not os.path.exists(path):
+        raise MigrationError("%s does not exist" % path)
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        start = version
+        if version == 0:
+            duplicates = findDuplicates(conn)
+            if duplicates:
+                raise MigrationError("%s: %s" % (path, "; ".join(duplicates)))
+        while version < len(MIGRATIONS):
+            # Each version is applied in its own transaction so a failure leaves the last good version
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                step = MIGRATIONS[version]
+                if callable(step):
+                    step(conn)
+                else:
+                    for sql in step:
+                        conn.execute(sql)
+                version += 1
+                conn.execute("PRAGMA user_version = %d" % version)
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                conn.execute("ROLLBACK")
+                raise
+        return start, version
+    finally:
+        conn.close()
+
+
+def main():
+    parser = ArgumentParser(description="Upgrade IOT registration databases in place")
+    parser.add_argument("databases", nargs="*", help="Database files to upgrade, every known IOT.db by default")
+    args = parser.parse_args()
+    failed = False
+    for path in args.databases or DATABASES:
+        try:
+            old, new = upgradeDatabase(path)
+            print("%s: version %d -> %d" % (os.path.normpath(path), old, new))
+        except (MigrationError, sqlite3.Error) as error:
+            print("%s: %s" % (os.path.normpath(path), error))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
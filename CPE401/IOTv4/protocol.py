@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Program: Message encodings for the University of Nevada, Reno CPE 401 IOT protocol
+# Filename: protocol.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+import struct
+from struct import Struct
+import hashlib
+import hmac
+
+# Every message is handled as a list of text fields, e.g. ['ACK', '70', 'test1', '1551312000', '9f86...'].
+# ASCII sends the fields joined by tabs. BINARY packs codes, numbers and hashes into fixed size integers and bytes,
+# about half the size of ASCII, but in Python it takes several times longer to encode and decode than a join and
+# split, so devices only ask for it when bandwidth matters more than CPU.
+ASCII = 'ASCII'
+BINARY = 'BIN1'
+# A device sends HELLO followed by the options it wants after connecting, e.g. HELLO<tab>BIN1<tab>BLAKE2B, and the
+# server answers HELLO followed by the ones it accepts. Devices that never send HELLO keep getting ASCII and SHA256
+HELLO = 'HELLO'
+# Every ACK carries a digest of the message it answers, computed from that message alone.
+# SHA256 is the default every device understands. On CPUs with SHA extensions neither digest is reliably faster
+# for messages this short, about 1 to 1.5 us each with run to run noise larger than the gap (benchmark.py times
+# both), so BLAKE2B is only an option a device can ask for in its HELLO. Once the server accepts it, digests on
+# that connection are BLAKE2b
+SHA256 = 'SHA256'
+BLAKE2 = 'BLAKE2B'
+DIGESTS = {SHA256: lambda data: hashlib.sha256(data).hexdigest(),
+           BLAKE2: lambda data: hashlib.blake2b(data, digest_size=32).hexdigest()}
+
+# Field kinds: s = string up to 255 bytes, S = string up to 4 GiB, c = two digit code, t = timestamp,
+# n = unsigned integer, h = hex digest sent as raw bytes
+# (type id, message name, code the message always carries or None, field kinds after the name)
+MESSAGES = [(1, 'REGISTER', None, 'sss'),
+            (2, 'DEREGISTER', None, 'sss'),
+            (3, 'LOGIN', None, 'sssn'),
+            (4, 'LOGOFF', None, 's'),
+            (5, 'DATA', '01', 'stnS'),
+            (6, 'DATA', '02', 'sn'),
+            (7, 'QUERY', None, 'csts'),
+            (8, 'ACK', None, 'csth')]
+# Type 0 carries the ASCII form of a message that does not fit any layout above
+RAW = 0
+# A request can carry an ID that the server copies onto its ACK, so a client can match replies to requests.
+# ASCII puts the ID first as '#<id>', binary sets this bit in the type byte and follows it with the ID
+TAGGED = 0x80
+# How each kind is stored in a layout's header: codes and numbers themselves, strings and digests by their length
+HEADER_FORMATS = {'s': 'B', 'S': 'I', 'c': 'B', 't': 'I', 'n': 'I', 'h': 'B'}
+
+u8 = Struct('!B')
+u32 = Struct('!I')
+
+
+def encodeAscii(fields):
+    return '\t'.join(fields).encode('ascii')
+
+
+def tagMessage(fields, requestId):
+    return ['#%d' % requestId] + fields
+
+
+# Splits the request ID off a decoded message, the ID is None for untagged messages
+def untagMessage(fields):
+    if fields and fields[0].startswith('#'):
+        return int(fields[0][1:]), fields[1:]
+    return None, fields
+
+
+# The binary form of one message type. A header packed by a single Struct holds the type byte, the request ID
+# if the message is tagged, every code and number, and the length of every string and digest. The string and
+# digest bytes follow the header in field order.
+# A loop over the field kinds costs more than the packing itself, so each layout writes out a pack and an unpack
+# function for its own fields once, at import, and runs those with no loop at all
+class Layout:
+    def __init__(self, typeId, name, code, kinds):
+        self.typeId = typeId
+        self.kinds = kinds
+        self.prefix = [name] if code is None else [name, code]
+        fields = ''.join(HEADER_FORMATS[kind] for kind in kinds)
+        self.header = Struct('!B' + fields)
+        self.taggedHeader = Struct('!BI' + fields)
+        scope = {'struct': struct, 'header': self.header, 'taggedHeader': self.taggedHeader, 'TAGGED': TAGGED,
+                 'tagMessage': tagMessage}
+        exec(self.packSource() + self.unpackSource(), scope)
+        self.pack = scope['pack']
+        self.unpack = scope['unpack']
+
+    # Writes pack(fields, requestId=None), which returns the packed message, or None when a field does not
+    # round-trip through the binary form or is too big for its slot in the header
+    def packSource(self):
+        skip = len(self.prefix)
+        lines = ["def pack(fields, requestId=None):",
+                 "    if len(fields) != %d:" % (skip + len(self.kinds)),
+                 "        return None",
+                 "    try:"]
+        values = []
+        tail = []
+        for i, kind in enumerate(self.kinds):
+            field = "fields[%d]" % (skip + i)
+            if kind == 'c':
+                lines += ["        if len(%s) != 2 or not %s.isdigit() or not %s.isascii():" % (field, field, field),
+                          "            return None"]
+                values.append("int(%s)" % field)
+            elif kind == 't' or kind == 'n':
+                # Only plain decimal numbers come back as the same text
+                lines += ["        v%d = int(%s)" % (i, field),
+                          "        if str(v%d) != %s:" % (i, field),
+                          "            return None"]
+                values.append("v%d" % i)
+            elif kind == 'h':
+                lines += ["        r%d = bytes.fromhex(%s)" % (i, field),
+                          "        if r%d.hex() != %s:" % (i, field),
+                          "            return None"]
+                values.append("len(r%d)" % i)
+                tail.append("r%d" % i)
+            else:
+                lines.append("        r%d = %s.encode('ascii')" % (i, field))
+                values.append("len(r%d)" % i)
+                tail.append("r%d" % i)
+        rest = ''.join(" + " + raw for raw in tail)
+        lines += ["        if requestId is None:",
+                  "            return header.pack(%d, %s)%s" % (self.typeId, ", ".join(values), rest),
+                  "        return taggedHeader.pack(%d, requestId, %s)%s" % (self.typeId | TAGGED, ", ".join(values),
+                                                                            rest),
+                  "    except (ValueError, struct.error):",
+                  "        return None",
+                  ""]
+        return "\n".join(lines) + "\n"
+
+    # Writes unpack(data, tagged), which raises ValueError when the frame is shorter or longer than its header says
+    def unpackSource(self):
+        names = "".join("v%d, " % i for i in range(len(self.kinds)))
+        lines = ["def unpack(data, tagged):",
+                 "    if tagged:",
+                 "        if len(data) < %d:" % self.taggedHeader.size,
+                 "            raise ValueError('Binary message type %d is cut short')" % self.typeId,
+                 "        _, requestId, %s= taggedHeader.unpack_from(data)" % names,
+                 "        o0 = %d" % self.taggedHeader.size,
+                 "    else:",
+                 "        if len(data) < %d:" % self.header.size,
+                 "            raise ValueError('Binary message type %d is cut short')" % self.typeId,
+                 "        _, %s= header.unpack_from(data)" % names,
+                 "        o0 = %d" % self.header.size]
+        fields = [repr(text) for text in self.prefix]
+        offset = 0
+        for i, kind in enumerate(self.kinds):
+            if kind == 'c':
+                fields.append("'%%02d' %% v%d" % i)
+            elif kind == 't' or kind == 'n':
+                fields.append("str(v%d)" % i)
+            else:
+                lines.append("    o%d = o%d + v%d" % (offset + 1, offset, i))
+                raw = "data[o%d:o%d]" % (offset, offset + 1)
+                fields.append(raw + ".hex()" if kind == 'h' else raw + ".decode('ascii')")
+                offset += 1
+        lines += ["    if o%d != len(data):" % offset,
+                  "        raise ValueError('Binary message type %d has %%d bytes, its header describes %%d' %% "
+                  "(len(data), o%d))" % (self.typeId, offset),
+                  "    fields = [%s]" % ", ".join(fields),
+                  "    if tagged:",
+                  "        return tagMessage(fields, requestId)",
+                  "    return fields",
+                  ""]
+        return "\n".join(lines) + "\n"
+
+
+byId = {}
+byName = {}
+for entry in MESSAGES:
+    layout = Layout(*entry)
+    byId[entry[0]] = layout
+    # Messages without a code are found by name alone, the others by name and code
+    byName[entry[1] if entry[2] is None else (entry[1], entry[2])] = layout
+
+
+# The digest an ACK carries for the message it answers, taken over the message's ASCII form without its request ID
+def digestMessage(fields, digest=SHA256):
+    return DIGESTS[digest](encodeAscii(fields))
+
+
+# Checks an ACK's digest against the message that was sent
+def verifyDigest(fields, hexdigest, digest=SHA256):
+    return hmac.compare_digest(digestMessage(fields, digest), hexdigest)
+
+
+def encodeBinary(fields):
+    requestId = None
+    if fields[0].startswith('#'):
+        requestId, fields = untagMessage(fields)
+    layout = byName.get(fields[0])
+    if layout is None and len(fields) > 1:
+        layout = byName.get((fields[0], fields[1]))
+    if layout is not None:
+        packed = layout.pack(fields, requestId)
+        if packed is not None:
+            return packed
+    if requestId is not None:
+        return u8.pack(RAW | TAGGED) + u32.pack(requestId) + encodeAscii(fields)
+    return u8.pack(RAW) + encodeAscii(fields)
+
+
+def encodeMessage(fields, codec):
+    if codec == BINARY:
+        return encodeBinary(fields)
+    return encodeAscii(fields)
+
+
+# Every malformed message raises ValueError, including text that is not ASCII
+def decodeBinary(data):
+    typeId = data[0]
+    tagged = typeId & TAGGED
+    typeId &= ~TAGGED
+    if typeId == RAW:
+        if tagged:
+            if len(data) < 1 + u32.size:
+                raise ValueError("Tagged message is cut short")
+            (requestId,) = u32.unpack_from(data, 1)
+            return tagMessage(data[5:].decode('ascii').split('\t'), requestId)
+        return data[1:].decode('ascii').split('\t')
+    layout = byId.get(typeId)
+    if layout is None:
+        raise ValueError("Unknown binary message type %d" % typeId)
+    return layout.unpack(data, tagged)
+
+
+# ASCII messages always start with a capital letter or '#', binary ones with a type id below 32 or the
+# tagged bit set, so either can be decoded without knowing what the connection negotiated
+def decodeMessage(data):
+    if data and (data[0] < 32 or data[0] & TAGGED):
+        return decodeBinary(data)
+    return data.decode('ascii').split('\t')
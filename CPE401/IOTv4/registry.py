@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Program: In-memory device registry for the University of Nevada, Reno CPE 401 IOT server
+# Filename: registry.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from threading import Lock
+from concurrent.futures import Future
+
+# Positions of the columns in a registration row
+DEVICE_ID, DEVICE_NAME, PASSPHRASE, MAC, IP, PORT, ACTIVE = range(7)
+
+
+# Keeps every registration row in memory, indexed by device name, MAC and IP.
+# Lookups never touch the database; every change is committed to the database before it is applied here.
+# When several processes share the database, shared is set and lookups read the database so they see every process.
+class DeviceRegistry:
+    def __init__(self, db, shared=False):
+        self.db = db
+        self.shared = shared
+        self.lock = Lock()
+        self.byName = {}
+        self.byMac = {}
+        self.byIp = {}
+
+    # Reads the whole registration table into memory
+    def load(self):
+        with self.lock:
+            self.byName.clear()
+            self.byMac.clear()
+            self.byIp.clear()
+            for row in self.db.allDevices():
+                self.index(tuple(row))
+
+    def index(self, row):
+        self.byName[row[DEVICE_NAME]] = row
+        self.byMac[row[MAC]] = row[DEVICE_NAME]
+        if row[IP]:
+            self.byIp.setdefault(row[IP], set()).add(row[DEVICE_NAME])
+
+    def unindex(self, row):
+        del self.byName[row[DEVICE_NAME]]
+        if self.byMac.get(row[MAC]) == row[DEVICE_NAME]:
+            del self.byMac[row[MAC]]
+        names = self.byIp.get(row[IP])
+        if names is not None:
+            names.discard(row[DEVICE_NAME])
+            if not names:
+                del self.byIp[row[IP]]
+
+    # Swaps the stored copy of a device for the row the database returned
+    def store(self, row):
+        old = self.byName.get(row[DEVICE_NAME])
+        if old is not None:
+            self.unindex(old)
+        self.index(tuple(row))
+
+    # The find functions return a list of matching rows, like a SELECT would
+    def findByName(self, deviceName):
+        if self.shared:
+            return self.db.findByName(deviceName)
+        row = self.byName.get(deviceName)
+        return [row] if row is not None else []
+
+    def findByMac(self, mac):
+        if self.shared:
+            return self.db.findByMac(mac)
+        deviceName = self.byMac.get(mac)
+        return [self.byName[deviceName]] if deviceName is not None else []
+
+    def findByIp(self, ip):
+        if self.shared:
+            return self.db.findByIp(ip)
+        return [self.byName[name] for name in self.byIp.get(ip, ())]
+
+    def activeDevices(self):
+        if self.shared:
+            return self.db.activeDevices()
+        with self.lock:
+            rows = [row for row in self.byName.values() if row[ACTIVE] == 1]
+        # Listed in registration order, the same order the table query gives
+        rows.sort(key=lambda row: row[DEVICE_ID])
+        return rows
+
+    # Applies a committed change to memory, then resolves the Future the caller is holding
+    def apply(self, change, update):
+        result = Future()
+
+        def done(future):
+            try:
+                row = future.result()
+            except Exception as error:
+                result.set_exception(error)
+                return
+            if row is not None:
+                with self.lock:
+                    update(row)
+            result.set_result(row)
+
+        change.add_done_callback(done)
+        return result
+
+    def remove(self, row):
+        old = self.byName.get(row[DEVICE_NAME])
+        if old is not None:
+            self.unindex(old)
+
+    # Each change returns a Future for the row the database wrote, or None when the statement matched nothing
+    def registerDevice(self, deviceName, passphrase, mac):
+        return self.apply(self.db.registerDevice(deviceName, passphrase, mac), self.store)
+
+    def loginDevice(self, deviceName, passphrase, ip, port):
+        return self.apply(self.db.loginDevice(deviceName, passphrase, ip, port), self.store)
+
+    def activateDevice(self, deviceName, ip, port):
+        return self.apply(self.db.activateDevice(deviceName, ip, port), self.store)
+
+    def logoffDevice(self, deviceName):
+        return self.apply(self.db.logoffDevice(deviceName), self.store)
+
+    def deregisterDevice(self, deviceName):
+        return self.apply(self.db.deregisterDevice(deviceName), self.remove)
+
+
+# Maps each logged in device to the socket it is connected on, and each socket back to its device
+class ConnectionRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        self.byName = {}
+        self.byConnection = {}
+
+    # Attaches a device to a connection, replacing any older connection the device had
+    def add(self, deviceName, connect):
+        with self.lock:
+            old = self.byName.get(deviceName)
+            if old is not None:
+                self.byConnection.pop(old, None)
+            self.byName[deviceName] = connect
+            self.byConnection[connect] = deviceName
+
+    def get(self, deviceName):
+        return self.byName.get(deviceName)
+
+    # Detaches a device when it logs off
+    def remove(self, deviceName):
+        with self.lock:
+            connect = self.byName.pop(deviceName, None)
+            if connect is not None:
+                self.byConnection.pop(connect, None)
+
+    # Detaches whichever device was using a connection that has closed, and returns its name
+    def drop(self, connect):
+        with self.lock:
+            deviceName = self.byConnection.pop(connect, None)
+            if deviceName is not None and self.byName.get(deviceName) is connect:
+                del self.byName[deviceName]
+            return deviceName
+
+    def __len__(self):
+        return len(self.byName)
@@ -7,15 +7,18 @@
 # Version: 1.0
 
 from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, gethostbyname, gethostname
-from threading import Thread, Timer
+from threading import Thread, Timer, Event
 import sqlite3
 import argparse as ap
 import hashlib
 import sys
 from time import time
 from random import randint
+import os
 from Crypto.PublicKey import RSA
-from Crypto import Random
+from keystore import loadOrCreateKey, KeyPool
+from tokens import saveToken, loadToken, removeToken
+from session import newSessionKey, wrapSessionKey, isSealed, Session, MessageBuffer, DEVICE_TO_SERVER
 
 # Use Command Line arguments to get pertinent information
 parser = ap.ArgumentParser()
@@ -45,22 +48,36 @@ class IOTclient:
     hostname = gethostname()
     IP = gethostbyname(hostname)
     conn = sqlite3.connect("IOT.db")
-    h = hashlib.sha256()
     AWS_IP = ''
     AWS_PORT = 0
     RSAPrivateKey = ''
     RSAPublicKey = ''
     ServerPublicKey = ''
     passhash = ''
-
-    # Constructor for the Object
-    def __init__(self, d, id, pp, m, p, s):
+    # Each device's key is saved here under its name and reused on every start, with its session token beside it
+    KEY_DIR = "keys"
+    # Spare keys for devices that have none yet, shared by every device started from this folder
+    SPARE_DIR = os.path.join(KEY_DIR, "spare")
+    # How long a message waits for the session to be set up before it is dropped
+    SESSION_TIMEOUT = 5.0
+
+    # Constructor for the Object. A KeyPool can be given so new devices take a key that is already made
+    def __init__(self, d, id, pp, m, p, s, keyPool=None):
         self.deviceName = d
         self.deviceID = id
         self.passPhrase = pp
         self.MAC = m
         self.serverPort = p
         self.server = s, p
+        self.keyPool = keyPool
+        self.keysReady = Event()
+        # The AES session for this connection, used once the server confirms it with KEY 03
+        self.session = None
+        self.sessionReady = Event()
+        # The session token from the last login, sent instead of the passphrase hash on the next one.
+        # It is kept on disk until it runs out, so it is still there after the device restarts
+        self.tokenPath = os.path.join(self.KEY_DIR, self.deviceName + ".token")
+        self.token = loadToken(self.tokenPath)
 
     # This binds the client to the listening port
     def bindClient(self):
@@ -68,31 +85,32 @@ class IOTclient:
         self.udpClient.bind((self.IP, 0))
         self.tcpAWS.bind((self.IP, 0))
         pass_encode = self.passPhrase.encode('ascii')
-        self.h.update(pass_encode)
-        self.passhash = self.h.hexdigest()
+        self.passhash = hashlib.sha256(pass_encode).hexdigest()
 
     # Send the register message to the server
     def register(self):
         reg = ("REGISTER\t" + self.deviceName + "\t" + self.passhash + "\t" + self.MAC)
         reg = reg.encode('ascii')
         self.sendServerMessage(reg)
-        self.sendKey()
 
     # Send the deregister message to the server
     def deregister(self):
+        self.setToken(None)
         dereg = ("DEREGISTER\t" + self.deviceName + "\t" + self.passhash + "\t" + self.MAC)
         dereg = dereg.encode('ascii')
         self.sendServerMessage(dereg)
 
-    # Send the login message to the server
+    # Send the login message to the server, with the session token in place of the passphrase hash if there is one
     def login(self):
         port = self.tcpClient.getsockname()
-        login = ("LOGIN\t" + self.deviceName + "\t" + self.passhash + "\t" + self.IP + "\t" + str(port[1]))
+        credential = self.token if self.token is not None else self.passhash
+        login = ("LOGIN\t" + self.deviceName + "\t" + credential + "\t" + self.IP + "\t" + str(port[1]))
         login = login.encode('ascii')
         self.sendServerMessage(login)
 
     # Send the logoff message to the server
     def logoff(self):
+        self.setToken(None)
         logoff = ("LOGOFF\t" + self.deviceName)
         logoff = logoff.encode('ascii')
         self.sendServerMessage(logoff)
@@ -167,8 +185,7 @@ class IOTclient:
         timeStamp = int(time())
         msg = self.remakeString(msg)
         tempMsg = msg.encode('ascii')
-        self.h.update(tempMsg)
-        hashed = self.h.hexdigest()
+        hashed = hashlib.sha256(tempMsg).hexdigest()
         message = ("ACK\t" + code + '\t' + self.deviceName + '\t' + str(timeStamp) + '\t' + hashed)
         messageE = message.encode('ascii')
         self.udpClient.sendto(messageE, addr)
@@ -199,6 +216,12 @@ class IOTclient:
             print("Device is not registered")
         elif msg[1] == '70':
             print("Device is logged on")
+            if len(msg) > 5:
+                self.setToken(msg[5])
+        elif msg[1] == '71':
+            print("Session token was refused, logging in with the passphrase")
+            self.setToken(None)
+            self.login()
         elif msg[1] == '80':
             print("Device id logged off")
 
@@ -210,21 +233,53 @@ class IOTclient:
 
     # Once a message is sent, this waits for a reply
     def processServerMessage(self):
+        buffer = MessageBuffer()
         while True:
             try:
                 data = self.tcpClient.recv(1024)
-                msg = data.decode('ascii')
-                newMsg = msg.split('\t')
-                if newMsg[0] == "QUERY":
-                    self.processQuery(newMsg)
-                elif newMsg[0] == "ACK":
-                    self.processServerACK(newMsg)
-                elif newMsg[0] == "DATA":
-                    self.processServerData(newMsg)
+                if not data:
+                    raise ConnectionError("Server closed the connection")
+                for message in buffer.feed(data):
+                    self.processServerReply(message)
             except:
                 print("Connection is closed or unavailable")
                 sys.exit(1)
 
+    # Handles one message from the server, opening it first if it is sealed
+    def processServerReply(self, data):
+        if isSealed(data):
+            data = self.openMessage(data)
+            if data is None:
+                return
+        msg = data.decode('ascii')
+        newMsg = msg.split('\t')
+        if newMsg[0] == "QUERY":
+            self.processQuery(newMsg)
+        elif newMsg[0] == "ACK":
+            self.processServerACK(newMsg)
+        elif newMsg[0] == "DATA":
+            self.processServerData(newMsg)
+        elif newMsg[0] == "KEY" and newMsg[1] == '03':
+            self.sessionReady.set()
+
+    # Remembers the session token, or forgets it when token is None, both here and on disk
+    def setToken(self, token):
+        self.token = token
+        if token is None:
+            removeToken(self.tokenPath)
+        else:
+            saveToken(token, self.tokenPath)
+
+    # Opens a sealed message from the server, or returns None if it does not authenticate
+    def openMessage(self, data):
+        if self.session is None:
+            return None
+        try:
+            return self.session.unseal(data)
+        except ValueError:
+            print("Dropped a message from the server that failed authentication")
+            return None
+
     def processClientMessage(self):
         while True:
             data, addr = self.udpClient.recvfrom(1024)
@@ -241,9 +296,16 @@ class IOTclient:
             elif newMsg == "STATUS":
                 self.clientACK(addr, "40", newMsg)
 
+    # Seals the message once the session is set up. While it is being set up the message waits for it.
+    # Nothing is sent in the clear, so if the server never confirms the session the message is dropped
     def sendServerMessage(self, msg):
+        if not self.sessionReady.wait(self.SESSION_TIMEOUT):
+            print("Server did not set up an encrypted session, message not sent")
+            return
         try:
-            self.tcpClient.send(msg)
+            # Sealed and sent together, so the server gets them in the order they were counted
+            with self.session.lock:
+                self.tcpClient.send(self.encrypt(msg))
         except:
             print("Socket has been closed or Server is offline, closing connection")
             self.tcpClient.close()
@@ -274,6 +336,12 @@ class IOTclient:
             msgE = msg.encode('ascii')
         if msg[1] == '03':
             self.ServerPublicKey = RSA.importKey(msg[2])
+            # The only RSA encrypt of the session, everything after it uses the AES key
+            sessionKey = newSessionKey()
+            self.session = Session(sessionKey, DEVICE_TO_SERVER)
+            wrapped = wrapSessionKey(self.ServerPublicKey, sessionKey)
+            msg = "KEY\t02\t" + self.deviceName + '\t' + wrapped
+            self.tcpClient.send(msg.encode('ascii'))
 
     def sendCloud(self):
         data = input("Enter a message to send to the cloud: ")
@@ -281,21 +349,30 @@ class IOTclient:
         msgE = msg.encode('ascii')
         self.tcpAWS.send(msgE)
 
+    # Loads or makes the device's key on a background thread so the menu does not wait for it
     def genKeys(self):
-        random_generator = Random.new().read
-        self.RSAPrivateKey = RSA.generate(1024, random_generator)
+        Thread(target=self.loadKeys, daemon=True).start()
+
+    def loadKeys(self):
+        path = os.path.join(self.KEY_DIR, self.deviceName + ".pem")
+        self.RSAPrivateKey = loadOrCreateKey(path, self.keyPool)
         self.RSAPublicKey = self.RSAPrivateKey.publickey()
-        #print(self.RSAPublicKey)
+        self.keysReady.set()
 
     def sendKey(self):
-        key = self.RSAPublicKey.exportKey("PEM")
-        msg = "KEY\t" + "01\t" + self.deviceName + '\t' + str(key)
+        # Only a brand new device can get here before its key is ready
+        self.keysReady.wait()
+        key = self.RSAPublicKey.exportKey("PEM").decode('ascii')
+        msg = "KEY\t" + "01\t" + self.deviceName + '\t' + key
         msgE = msg.encode('ascii')
-        #enc_data = self.encrypt(msgE)
         self.tcpClient.send(msgE)
 
+    # Starts the key exchange in session.py. Messages sent meanwhile wait for it in sendServerMessage
+    def startSession(self):
+        Thread(target=self.sendKey, daemon=True).start()
+
     def encrypt(self, string):
-        enc_data = self.ServerPublicKey.encrypt(string, 30)
+        enc_data = self.session.seal(string)
         return enc_data
 
 
@@ -339,7 +416,8 @@ def MACprettyprint(mac):
 def main():
     # Initialize the device with values
     mac = MACprettyprint(randomMAC())
-    device = IOTclient(args["device"], args["id"], "toor", mac, int(args["port"]), args["server"])
+    keyPool = KeyPool(IOTclient.SPARE_DIR)
+    device = IOTclient(args["device"], args["id"], "toor", mac, int(args["port"]), args["server"], keyPool)
     device.bindClient()
     device.serverconnect()
     device.genKeys()
@@ -347,6 +425,9 @@ def main():
     udpListener = Thread(target=device.processClientMessage, daemon=True)
     tcpListener.start()
     udpListener.start()
+    device.startSession()
+    # Makes spare keys while the device runs, so the next new device on this host does not wait for one
+    keyPool.start()
     mainMenu(device)
     tcpListener.join(0.1)
     udpListener.join(0.1)
@@ -8,13 +8,16 @@
 
 from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, gethostname, gethostbyname
 import sqlite3
+import hashlib
 from time import time
 from argparse import ArgumentParser
-import hashlib
 from threading import Thread
 import logging
 from Crypto.PublicKey import RSA
-from Crypto import Random
+from keystore import loadOrCreateKey, KeyCache
+from session import isSealed, Session, MessageBuffer, SERVER_TO_DEVICE
+from cryptopool import CryptoService
+from tokens import TokenSigner, isToken, loadOrCreateSecret
 
 # Command line arguments for the port to start the server on
 parser = ArgumentParser()
@@ -34,7 +37,6 @@ class IOTserver:
     AWS_IP = "ec2-18-222-250-95.us-east-2.compute.amazonaws.com"
     AWS_PORT = 59000
     print("Server at: ", TCP_IP)
-    h = hashlib.sha256()
     addr = ''
     threads = []
     tcpListener = []
@@ -44,32 +46,58 @@ class IOTserver:
                         datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
     RSAPrivateKey = ''
     RSAPublicKey = ''
+    RSAPrivateDer = b''
+    # The server's key is made once and reused on every start
+    KEY_FILE = "ServerKey.pem"
+    # The secret session tokens are signed with, kept so tokens outlive a restart
+    TOKEN_SECRET_FILE = "ServerToken.key"
+    # How many devices' parsed public keys are kept in memory
+    KEY_CACHE_SIZE = 1024
 
     # Take the command line port and give it to the server
 
     def __init__(self, p):
         self.TCP_PORT = p
+        # The AES session each connection set up with KEY 02, see session.py
+        self.sessions = {}
+        self.publicKeys = KeyCache(self.KEY_CACHE_SIZE)
+        # RSA runs in worker processes instead of the threads serving sockets
+        self.crypto = CryptoService()
+        # Signs the session tokens a device can log in with instead of its passphrase
+        self.tokens = TokenSigner(secret=loadOrCreateSecret(self.TOKEN_SECRET_FILE))
 
     # Starts the server and connects to the Database
     def startServer(self):
+        self.crypto.start()
         self.tcpServer.bind((self.TCP_IP, self.TCP_PORT))
         self.tcpAWS.bind((self.TCP_IP, 6711))
         self.tcpAWS.connect((self.AWS_IP, self.AWS_PORT))
-        random_generator = Random.new().read
-        self.RSAPrivateKey = RSA.generate(1024, random_generator)
+        self.RSAPrivateKey = loadOrCreateKey(self.KEY_FILE, self.crypto)
         self.RSAPublicKey = self.RSAPrivateKey.publickey()
+        self.RSAPrivateDer = self.RSAPrivateKey.exportKey('DER')
         logging.info("Server is Online at %s:%s", self.TCP_IP, self.TCP_PORT)
         logging.info("Server connected to AWS")
 
-    # Generates the ACK message to send to the device
-    def ackMessage(self, code, deviceID, msg, connect):
+    # Generates the ACK message to send to the device, the hash covers only the message being answered.
+    # A login's ACK also carries the device's session token
+    def ackMessage(self, code, deviceID, msg, connect, token=None):
         timeStamp = int(time())
-        tempMsg = msg.encode('ascii')
-        self.h.update(tempMsg)
-        hashed = self.h.hexdigest()
+        hashed = hashlib.sha256(msg.encode('ascii')).hexdigest()
         message = ("ACK\t" + code + '\t' + deviceID + '\t' + str(timeStamp) + '\t' + hashed)
+        if token is not None:
+            message += '\t' + token
         messageE = message.encode('ascii')
-        connect.send(messageE)
+        self.sendMessage(messageE, connect)
+
+    # Sends a message to the device, sealed with the connection's session once it has one. Callbacks from the
+    # crypto pool send on the same connection, so a message is sealed and sent while holding the session's lock
+    def sendMessage(self, messageE, connect):
+        session = self.sessions.get(connect)
+        if session is None:
+            connect.send(messageE)
+            return
+        with session.lock:
+            connect.send(session.seal(messageE))
 
     # Generates the query message for data requested by the server
     def queryMessage(self):
@@ -99,7 +127,7 @@ class IOTserver:
             connect = self.connectionQueue[int(selection) - 1]
             msg = ("QUERY\t" + code + "\t" + deviceID + "\t" + str(timeStamp) + "\t" + param)
             msg = msg.encode('ascii')
-            connect.send(msg)
+            self.sendMessage(msg, connect)
             cur.close()
             conn.close()
 
@@ -154,7 +182,7 @@ class IOTserver:
                 conn.commit()
                 msgD = ("DATA\t" + '02' + "\t" + self.AWS_IP + "\t" + str(59000))
                 msgE = msgD.encode('ascii')
-                connect.send(msgE)
+                self.sendMessage(msgE, connect)
                 msg = self.remakeString(data)
                 self.ackMessage('00', data[1], msg, connect)
                 cur.close()
@@ -181,6 +209,8 @@ class IOTserver:
             sql = 'DELETE FROM Keys where deviceName=? '
             cur.execute(sql, (deviceName,))
             conn.commit()
+            self.publicKeys.remove(deviceName)
+            self.tokens.revoke(deviceName)
             msg = self.remakeString(data)
             self.ackMessage('20', data[1], msg, connect)
             cur.close()
@@ -252,30 +282,42 @@ class IOTserver:
 
     # Logs in the device
     def loginDevice(self, data, connect):
-        print("HERE")
-        conn = sqlite3.connect('IOT.db')
-        cur = conn.cursor()
         deviceName = data[1]
         ip = data[3]
-        print(data[2])
         port = int(data[4])
         msg = self.remakeString(data)
-        device = self.lookup(deviceName, '', '')
 
+        # A session token from an earlier login is checked in memory instead of looking up the passphrase
+        if isToken(data[2]):
+            if self.tokens.check(deviceName, data[2]):
+                logging.info("%s has logged in with a session token", deviceName)
+                self.activateDevice(deviceName, ip, port)
+                self.ackMessage('70', deviceName, msg, connect, self.tokens.issue(deviceName))
+            else:
+                self.ackMessage('71', deviceName, msg, connect)
+            return
+
+        device = self.lookup(deviceName, '', '')
         # Changes the status of the device to active
         if device[0]:
             if device[1][0][2] == data[2] and device[1][0][6] == 0:
                 logging.info("%s has logged in", deviceName)
-                sql = "UPDATE registration SET ip=?, port=?, active=? WHERE deviceName=?"
-                update = (ip, port, 1, deviceName)
-                cur.execute(sql, update)
-                conn.commit()
-                cur.close()
-                conn.close()
-                self.ackMessage('70', deviceName, msg, connect)
+                self.activateDevice(deviceName, ip, port)
+                self.ackMessage('70', deviceName, msg, connect, self.tokens.issue(deviceName))
         else:
             self.ackMessage('31', deviceName, msg, connect)
 
+    # Records where the device can be reached and marks it active
+    def activateDevice(self, deviceName, ip, port):
+        conn = sqlite3.connect('IOT.db')
+        cur = conn.cursor()
+        sql = "UPDATE registration SET ip=?, port=?, active=? WHERE deviceName=?"
+        update = (ip, port, 1, deviceName)
+        cur.execute(sql, update)
+        conn.commit()
+        cur.close()
+        conn.close()
+
     # Logs off the device from the server
     def logoffDevice(self, data, connect):
         conn = sqlite3.connect('IOT.db')
@@ -286,6 +328,7 @@ class IOTserver:
         if device[0]:
             if device[1][0][6] == 1:
                 logging.info('%s has logged off', deviceName)
+                self.tokens.revoke(deviceName)
                 sql = "UPDATE registration SET active=? WHERE deviceName=?"
                 update = (0, deviceName)
                 cur.execute(sql, update)
@@ -296,9 +339,22 @@ class IOTserver:
         else:
             self.ackMessage('31', deviceName, msg, connect)
 
-    # Processes the message that the client sends
+    # Processes the message that the client sends. Sealed messages are opened with the connection's session key,
+    # and dropped if they do not authenticate. Once a connection has a session, plain messages are dropped too,
+    # so nothing can be slipped in around the encryption
     def processMessage(self, data, connect):
-        #dec_data = self.RSAPrivateKey.decrypt(data)
+        session = self.sessions.get(connect)
+        if session is not None and not isSealed(data):
+            logging.info("Dropped a message that was not sealed")
+            return
+        if isSealed(data):
+            if session is None:
+                return
+            try:
+                data = session.unseal(data)
+            except ValueError:
+                logging.info("Dropped a message that failed authentication or was sent again")
+                return
         tempData = data.decode('ascii')
         msg = tempData.split('\t')
         if msg[0] == 'REGISTER':
@@ -325,17 +381,73 @@ class IOTserver:
         if msg[1] == '01':
             self.sendData(msg)
 
+    # KEY 01 carries the device's public key and is answered with the server's.
+    # KEY 02 carries the session key, the only RSA decrypt the connection needs, done in the crypto pool
     def processKey(self, msg, connect):
         if msg[1] == '01':
-            conn = sqlite3.connect('IOT.db')
-            cur = conn.cursor()
-            sql = '''insert into Keys(deviceName,publicKey) values (?,?)'''
-            keys = (msg[2], msg[3])
-            cur.execute(sql, keys)
-            conn.commit()
-            msg = "DATA\t03\t" + str(self.RSAPublicKey.exportKey("PEM"))
+            try:
+                publicKey = RSA.importKey(msg[3])
+            except (ValueError, IndexError, TypeError):
+                logging.info("%s sent a public key that could not be read", msg[2])
+                return
+            # A device sends the key it saved on every connect, so the row is only rewritten when the key changed
+            known = self.publicKey(msg[2])
+            if known is None or (known.n, known.e) != (publicKey.n, publicKey.e):
+                self.storePublicKey(msg[2], publicKey)
+            msg = "DATA\t03\t" + self.RSAPublicKey.exportKey("PEM").decode('ascii')
             msgE = msg.encode('ascii')
-            connect.send(msgE)
+            self.sendMessage(msgE, connect)
+        elif msg[1] == '02':
+            sessionKey = self.crypto.unwrapSessionKey(self.RSAPrivateDer, msg[3])
+            sessionKey.add_done_callback(lambda done: self.startSession(msg[2], done, connect))
+
+    def startSession(self, deviceName, done, connect):
+        try:
+            sessionKey = done.result()
+        except ValueError:
+            logging.info("%s sent a session key that could not be decrypted", deviceName)
+            return
+        # The device may have gone while the key was decrypted
+        if connect not in self.connectionQueue:
+            return
+        self.sessions[connect] = Session(sessionKey, SERVER_TO_DEVICE)
+        # Sealed with the new key, so the device knows the server has it
+        reply = "KEY\t03\t" + deviceName
+        self.sendMessage(reply.encode('ascii'), connect)
+
+    # Keeps one key per device, stored as DER, and puts the parsed key in the cache
+    def storePublicKey(self, deviceName, publicKey):
+        conn = sqlite3.connect('IOT.db')
+        cur = conn.cursor()
+        cur.execute('DELETE FROM Keys where deviceName=?', (deviceName,))
+        sql = '''insert into Keys(deviceName,publicKey) values (?,?)'''
+        cur.execute(sql, (deviceName, publicKey.exportKey('DER')))
+        conn.commit()
+        cur.close()
+        conn.close()
+        self.publicKeys.put(deviceName, publicKey)
+
+    # Returns a device's parsed public key, or None if it has not sent one. Only a cache miss reads the
+    # Keys table. Rows saved as text before keys were stored as DER are converted by migrate.py; one it
+    # could not read counts as no key, and is replaced when the device sends KEY 01
+    def publicKey(self, deviceName):
+        publicKey = self.publicKeys.get(deviceName)
+        if publicKey is not None:
+            return publicKey
+        conn = sqlite3.connect('IOT.db')
+        cur = conn.cursor()
+        cur.execute('SELECT publicKey FROM Keys where deviceName=?', (deviceName,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+        if row is None:
+            return None
+        try:
+            publicKey = RSA.importKey(row[0])
+        except ValueError:
+            return None
+        self.publicKeys.put(deviceName, publicKey)
+        return publicKey
 
     def sendData(self, msg):
         self.lookup()
@@ -351,9 +463,18 @@ class IOTserver:
             self.threads.append(newthread)
 
     def recieveData(self, connect):
+        buffer = MessageBuffer()
         while True:
             data = connect.recv(2048)
-            self.processMessage(data, connect)
+            # An empty read means the device closed the socket
+            if not data:
+                break
+            for message in buffer.feed(data):
+                self.processMessage(message, connect)
+        self.sessions.pop(connect, None)
+        if connect in self.connectionQueue:
+            self.connectionQueue.remove(connect)
+        connect.close()
 
     # Menu for the server to send queries
     def menu(self):
@@ -380,6 +501,7 @@ def main():
     tcpListener.start()
     server.menu()
     tcpListener.join(0.1)
+    server.crypto.stop()
 
 
 if __name__ == "__main__":
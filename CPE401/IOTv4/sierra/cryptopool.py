@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Program: Process pool for the crypto work of the University of Nevada, Reno CPE 401 IOT sierra server
+# Filename: cryptopool.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+# RSA holds the GIL while it runs, so done on the threads that serve sockets it stalls every other
+# connection. CryptoService runs it in worker processes and hands back a Future. Hashes stay inline:
+# a sha256 of a message takes about a microsecond, far less than sending it to a worker would
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from Crypto.PublicKey import RSA
+from keystore import KEY_BITS, generateKey
+from session import unwrapSessionKey
+
+# The private keys a worker has already parsed, by their DER encoding
+privateKeys = {}
+
+
+# Run once by start() so every worker is forked before the server has threads of its own
+def ready():
+    return True
+
+
+def generateDer(bits):
+    return generateKey(bits).exportKey('DER')
+
+
+def unwrapWith(keyDer, text):
+    privateKey = privateKeys.get(keyDer)
+    if privateKey is None:
+        privateKey = privateKeys[keyDer] = RSA.importKey(keyDer)
+    return unwrapSessionKey(privateKey, text)
+
+
+# The RSA work of the server. Each job is a Future resolved on the pool's own thread, so callbacks should not block
+class CryptoService:
+    def __init__(self, workers=None):
+        # Workers are forked so they start without importing the server again
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('fork'))
+        self.started = False
+
+    # Forks every worker, so call it before the server starts any threads of its own
+    def start(self):
+        if not self.started:
+            self.pool.submit(ready).result()
+            self.started = True
+
+    # Waits for the jobs already submitted and stops the workers
+    def stop(self):
+        self.pool.shutdown()
+
+    # Decrypts a KEY 02 session key with the private key given in DER form
+    def unwrapSessionKey(self, keyDer, text):
+        return self.pool.submit(unwrapWith, keyDer, text)
+
+    # A Future for a new RSA key in DER form
+    def generateKey(self, bits=KEY_BITS):
+        return self.pool.submit(generateDer, bits)
+
+    # Generates a key in a worker and waits for it, so the service can stand in for a KeyPool in loadOrCreateKey
+    def get(self):
+        return RSA.importKey(self.generateKey().result())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Program: RSA key storage for the University of Nevada, Reno CPE 401 IOT sierra server and client
+# Filename: keystore.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+from threading import Thread, Lock, Event
+from uuid import uuid4
+from collections import OrderedDict
+import os
+from Crypto.PublicKey import RSA
+from Crypto import Random
+
+KEY_BITS = 1024
+
+
+# Keeps a few spare keys generated ahead of time in folder, so a new device takes a key that is ready instead
+# of waiting for the primes to be found. The spares are files, so a key made while one device runs is there for
+# the next new device started on this host. A background thread tops the folder back up after a key is taken
+class KeyPool:
+    def __init__(self, folder, size=2, bits=KEY_BITS):
+        self.folder = folder
+        self.size = size
+        self.bits = bits
+        self.taken = Event()
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def spares(self):
+        try:
+            return sorted(name for name in os.listdir(self.folder) if name.endswith('.pem'))
+        except FileNotFoundError:
+            return []
+
+    # Fills the folder up to size keys, then sleeps until one is taken
+    def run(self):
+        while True:
+            while len(self.spares()) < self.size:
+                saveKey(generateKey(self.bits), os.path.join(self.folder, uuid4().hex + '.pem'))
+            self.taken.wait()
+            self.taken.clear()
+
+    # Takes a spare key, or generates one here if there are none yet. Renaming the file claims it, so two
+    # devices starting at once never get the same key
+    def get(self):
+        self.start()
+        key = None
+        for name in self.spares():
+            spare = os.path.join(self.folder, name)
+            claimed = spare + '.taken'
+            try:
+                os.rename(spare, claimed)
+            except FileNotFoundError:
+                continue
+            key = loadKey(claimed)
+            os.remove(claimed)
+            break
+        self.taken.set()
+        return key if key is not None else generateKey(self.bits)
+
+
+# Parsed public keys by device name, so a key is only read from the Keys table and parsed once.
+# The least recently used key is dropped once more than size are held
+class KeyCache:
+    def __init__(self, size=1024):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, deviceName):
+        with self.lock:
+            key = self.keys.get(deviceName)
+            if key is not None:
+                self.keys.move_to_end(deviceName)
+            return key
+
+    def put(self, deviceName, key):
+        with self.lock:
+            self.keys[deviceName] = key
+            self.keys.move_to_end(deviceName)
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def remove(self, deviceName):
+        with self.lock:
+            self.keys.pop(deviceName, None)
+
+
+def generateKey(bits=KEY_BITS):
+    return RSA.generate(bits, Random.new().read)
+
+
+def loadKey(path):
+    with open(path, 'rb') as keyFile:
+        return RSA.importKey(keyFile.read())
+
+
+# Writes a file only this user can read. It is written to a temporary file first, so a crash part way
+# through never leaves a half written file behind
+def saveSecret(data, path):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp = path + '.tmp'
+    descriptor = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as secretFile:
+        secretFile.write(data)
+    os.replace(temp, path)
+
+
+def saveKey(key, path):
+    saveSecret(key.exportKey('PEM'), path)
+
+
+# Reuses the key saved at path, or takes a new one from the pool (or generates it) and saves it there
+def loadOrCreateKey(path, pool=None):
+    if os.path.exists(path):
+        return loadKey(path)
+    key = pool.get() if pool is not None else generateKey()
+    saveKey(key, path)
+    return key
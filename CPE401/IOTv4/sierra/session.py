@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Program: Session encryption for the University of Nevada, Reno CPE 401 IOT sierra server and client
+# Filename: session.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+# RSA is only used once per connection, to send the server a random AES key:
+#   device -> server  KEY<tab>01<tab>deviceName<tab>device public key
+#   server -> device  DATA<tab>03<tab>server public key
+#   device -> server  KEY<tab>02<tab>deviceName<tab>AES key encrypted with the server's public key (hex)
+#   server -> device  KEY<tab>03<tab>deviceName, sealed with the AES key to show the server has it
+# After that every message on the connection is sealed with AES-GCM and sent as ENC<tab>base64(nonce tag ciphertext)
+# followed by a newline. Base64 never contains a newline, so several sealed messages read together can be split apart.
+# The nonce is the direction the message travels followed by a count of the messages sent that way. Each side only
+# accepts the other direction with a higher count than the last, so a captured message cannot be sent again
+
+from base64 import b64encode, b64decode
+from struct import Struct
+from threading import RLock
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Random import get_random_bytes
+
+SESSION_KEY_BYTES = 16
+NONCE_BYTES = 12
+TAG_BYTES = 16
+SEALED = b"ENC\t"
+SEALED_END = b"\n"
+# The directions a session's messages travel in, the first part of every nonce
+DEVICE_TO_SERVER = 0
+SERVER_TO_DEVICE = 1
+nonceHeader = Struct('>IQ')
+
+
+def newSessionKey():
+    return get_random_bytes(SESSION_KEY_BYTES)
+
+
+# Encrypts the session key with the other side's public key, as hex so it fits in a tab separated message
+def wrapSessionKey(publicKey, sessionKey):
+    return PKCS1_OAEP.new(publicKey).encrypt(sessionKey).hex()
+
+
+def unwrapSessionKey(privateKey, text):
+    return PKCS1_OAEP.new(privateKey).decrypt(bytes.fromhex(text))
+
+
+def isSealed(data):
+    return data.startswith(SEALED)
+
+
+# One side of a connection's session. A message has to be sent in the order it was sealed, so a connection
+# used by several threads seals and sends while holding lock
+class Session:
+    def __init__(self, key, sending):
+        self.key = key
+        self.sending = sending
+        self.sent = 0
+        self.received = 0
+        self.lock = RLock()
+
+    def seal(self, data):
+        with self.lock:
+            self.sent += 1
+            nonce = nonceHeader.pack(self.sending, self.sent)
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_BYTES)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return SEALED + b64encode(nonce + tag + ciphertext) + SEALED_END
+
+    # Returns the original message, or raises ValueError if it was changed, cut short, sealed with another key,
+    # sent by this side or already received
+    def unseal(self, data):
+        if data.endswith(SEALED_END):
+            data = data[:-len(SEALED_END)]
+        raw = b64decode(data[len(SEALED):], validate=True)
+        if len(raw) < NONCE_BYTES + TAG_BYTES:
+            raise ValueError("Sealed message is too short")
+        nonce = raw[:NONCE_BYTES]
+        tag = raw[NONCE_BYTES:NONCE_BYTES + TAG_BYTES]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_BYTES)
+        message = cipher.decrypt_and_verify(raw[NONCE_BYTES + TAG_BYTES:], tag)
+        direction, count = nonceHeader.unpack(nonce)
+        if direction == self.sending:
+            raise ValueError("Sealed message was sent by this side")
+        with self.lock:
+            if count <= self.received:
+                raise ValueError("Sealed message was already received")
+            self.received = count
+        return message
+
+
+# Splits what is read from a connection into messages. Sealed messages are held until their newline arrives.
+# Plain messages are only sent while the session is set up, one at a time, and are passed on as they were read
+class MessageBuffer:
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while self.buffer:
+            if not self.buffer.startswith(SEALED):
+                # Could still be the start of a sealed message
+                if SEALED.startswith(self.buffer):
+                    break
+                messages.append(self.buffer)
+                self.buffer = b''
+                break
+            end = self.buffer.find(SEALED_END)
+            if end < 0:
+                break
+            messages.append(self.buffer[:end + len(SEALED_END)])
+            self.buffer = self.buffer[end + len(SEALED_END):]
+        return messages
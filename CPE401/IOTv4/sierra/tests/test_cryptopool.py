@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from Crypto.PublicKey import RSA
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cryptopool import CryptoService
+from keystore import generateKey, loadOrCreateKey
+from session import newSessionKey, wrapSessionKey
+
+
+class CryptoServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.service = CryptoService(workers=1)
+        cls.service.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.stop()
+
+    def test_session_key_is_unwrapped_in_a_worker(self):
+        privateKey = generateKey()
+        keyDer = privateKey.exportKey('DER')
+        for i in range(2):
+            # The second time the worker uses the key it has already parsed
+            sessionKey = newSessionKey()
+            text = wrapSessionKey(privateKey.publickey(), sessionKey)
+            self.assertEqual(self.service.unwrapSessionKey(keyDer, text).result(), sessionKey)
+
+    def test_bad_session_key_fails_the_future(self):
+        keyDer = generateKey().exportKey('DER')
+        text = wrapSessionKey(generateKey().publickey(), newSessionKey())
+        with self.assertRaises(ValueError):
+            self.service.unwrapSessionKey(keyDer, text).result()
+
+    def test_generated_keys_are_private_keys(self):
+        key = RSA.importKey(self.service.generateKey().result())
+        self.assertTrue(key.has_private())
+        self.assertTrue(self.service.get().has_private())
+
+    def test_service_stands_in_for_a_key_pool(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'ServerKey.pem')
+            key = loadOrCreateKey(path, self.service)
+            self.assertEqual(loadOrCreateKey(path).exportKey('DER'), key.exportKey('DER'))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keystore import KeyPool, KeyCache, loadOrCreateKey
+
+
+class KeyPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.spares = os.path.join(self.folder, 'spare')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_new_device_takes_a_spare(self):
+        pool = KeyPool(self.spares, size=1)
+        spare = pool.get()
+        # Nothing was ready yet, so that key was made on the spot and the thread makes the next one
+        while not pool.spares():
+            sleep(0.05)
+        name = pool.spares()[0]
+        path = os.path.join(self.folder, 'a.pem')
+        key = loadOrCreateKey(path, pool)
+        self.assertNotIn(name, os.listdir(self.spares))
+        self.assertNotEqual(key.n, spare.n)
+        self.assertEqual(loadOrCreateKey(path).n, key.n)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+
+class KeyCacheTest(unittest.TestCase):
+    def test_get_put_remove(self):
+        cache = KeyCache(size=2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 'key a')
+        self.assertEqual(cache.get('a'), 'key a')
+        cache.remove('a')
+        self.assertIsNone(cache.get('a'))
+        # Removing a key that is not cached is fine
+        cache.remove('a')
+
+    def test_least_recently_used_key_is_dropped(self):
+        cache = KeyCache(size=2)
+        cache.put('a', 'key a')
+        cache.put('b', 'key b')
+        cache.get('a')
+        cache.put('c', 'key c')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), ('key a', 'key c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
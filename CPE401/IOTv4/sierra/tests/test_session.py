@@ -0,0 +1,80 @@
+import os
+import sys
+import unittest
+from base64 import b64encode, b64decode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keystore import generateKey
+from session import Session, MessageBuffer, newSessionKey, wrapSessionKey, unwrapSessionKey, isSealed, \
+    SEALED, SEALED_END, DEVICE_TO_SERVER, SERVER_TO_DEVICE
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        key = newSessionKey()
+        self.device = Session(key, DEVICE_TO_SERVER)
+        self.server = Session(key, SERVER_TO_DEVICE)
+
+    def test_round_trip_both_ways(self):
+        sealed = self.device.seal(b'LOGIN\ta\ttoor\t10.0.0.5\t5000')
+        self.assertTrue(isSealed(sealed))
+        self.assertTrue(sealed.endswith(SEALED_END))
+        self.assertEqual(self.server.unseal(sealed), b'LOGIN\ta\ttoor\t10.0.0.5\t5000')
+        self.assertEqual(self.device.unseal(self.server.seal(b'KEY\t03\ta')), b'KEY\t03\ta')
+
+    def test_replay_is_rejected(self):
+        first = self.device.seal(b'DEREGISTER\ta')
+        second = self.device.seal(b'DATA\t01\ta')
+        self.assertEqual(self.server.unseal(first), b'DEREGISTER\ta')
+        with self.assertRaises(ValueError):
+            self.server.unseal(first)
+        self.assertEqual(self.server.unseal(second), b'DATA\t01\ta')
+        # Nor can an older message be sent after a newer one
+        with self.assertRaises(ValueError):
+            self.server.unseal(first)
+
+    def test_reflected_message_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.device.unseal(self.device.seal(b'LOGOFF\ta'))
+
+    def test_tampered_message_is_rejected(self):
+        sealed = self.device.seal(b'DATA\t01\ta')
+        raw = bytearray(b64decode(sealed[len(SEALED):-len(SEALED_END)]))
+        raw[-1] ^= 1
+        tampered = SEALED + b64encode(bytes(raw)) + SEALED_END
+        for data in (tampered, sealed[:20] + SEALED_END, SEALED + b'!!!!' + SEALED_END):
+            with self.assertRaises(ValueError):
+                self.server.unseal(data)
+        with self.assertRaises(ValueError):
+            Session(newSessionKey(), SERVER_TO_DEVICE).unseal(sealed)
+        # The real message still goes through once the bad ones are dropped
+        self.assertEqual(self.server.unseal(sealed), b'DATA\t01\ta')
+
+    def test_wrapped_key(self):
+        privateKey = generateKey()
+        key = newSessionKey()
+        self.assertEqual(unwrapSessionKey(privateKey, wrapSessionKey(privateKey.publickey(), key)), key)
+
+
+class MessageBufferTest(unittest.TestCase):
+    def test_sealed_messages_split_across_reads(self):
+        device = Session(newSessionKey(), DEVICE_TO_SERVER)
+        messages = [device.seal(b'REGISTER\ta'), device.seal(b'x' * 3000), device.seal(b'LOGOFF\ta')]
+        stream = b''.join(messages)
+        buffer = MessageBuffer()
+        received = []
+        for i in range(0, len(stream), 5):
+            received += buffer.feed(stream[i:i + 5])
+        self.assertEqual(received, messages)
+
+    def test_plain_message_is_passed_on(self):
+        buffer = MessageBuffer()
+        self.assertEqual(buffer.feed(b'KEY\t01\ta\tkey'), [b'KEY\t01\ta\tkey'])
+        # The start of a sealed message is held until the rest arrives
+        self.assertEqual(buffer.feed(b'EN'), [])
+        self.assertEqual(buffer.feed(b'C\tabc\n'), [b'ENC\tabc\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
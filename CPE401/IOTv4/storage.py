@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# Program: Registration database access for the University of Nevada, Reno CPE 401 IOT server
+# Filename: storage.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+import sqlite3
+from threading import local
+from concurrent.futures import Future
+from time import monotonic
+from metrics import Metrics
+from dispatch import BatchWorker
+
+# The SQL is kept in constants so sqlite3 reuses the prepared statements on every call
+FIND_ALL = "SELECT * FROM registration ORDER BY deviceID"
+FIND_NAME = "SELECT * FROM registration WHERE deviceName=?"
+FIND_IP = "SELECT * FROM registration WHERE ip=?"
+FIND_MAC = "SELECT * FROM registration WHERE mac=?"
+# active is written as a literal so the partial index on active = 1 can be used
+FIND_ACTIVE = "SELECT * FROM registration WHERE active = 1 ORDER BY deviceID"
+# Each change is one atomic statement; the row it returns says whether it took effect.
+# A name that is already registered returns no row, a MAC that belongs to another device raises IntegrityError
+REGISTER_DEVICE = """INSERT INTO registration(deviceName, passphrase, mac, active) VALUES(?,?,?,0)
+                     ON CONFLICT(deviceName) DO NOTHING RETURNING *"""
+LOGIN_DEVICE = """UPDATE registration SET ip=?, port=?, active=1
+                  WHERE deviceName=? AND passphrase=? AND active=0 RETURNING *"""
+# A login with a valid token skips the passphrase
+ACTIVATE_DEVICE = """UPDATE registration SET ip=?, port=?, active=1
+                     WHERE deviceName=? AND active=0 RETURNING *"""
+LOGOFF_DEVICE = "UPDATE registration SET active=0 WHERE deviceName=? AND active=1 RETURNING *"
+DEREGISTER_DEVICE = "DELETE FROM registration WHERE deviceName=? RETURNING *"
+# No device is connected while the server starts, so anything still marked active was left by a crash
+LOGOFF_ALL = "UPDATE registration SET active=0 WHERE active=1"
+# The label each statement is timed under
+STATEMENTS = {REGISTER_DEVICE: "register", LOGIN_DEVICE: "login", ACTIVATE_DEVICE: "activate",
+              LOGOFF_DEVICE: "logoff", DEREGISTER_DEVICE: "deregister", LOGOFF_ALL: "logoffAll"}
+
+
+# Owns the only connection that writes to the registration database.
+# Changes from every connection handler are queued here and committed together, so a burst of logins
+# costs one fsync per batch instead of one per device. Each change's Future resolves after its batch is durable.
+class GroupCommitWriter(BatchWorker):
+    def __init__(self, path, batchDelay=0.002, batchSize=256, cacheSize=64, metrics=None):
+        BatchWorker.__init__(self, batchSize, batchDelay)
+        self.path = path
+        self.cacheSize = cacheSize
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.conn = None
+
+    # Queues one statement and returns a Future for the rows it returns
+    def submit(self, sql, params):
+        future = Future()
+        self.queue.put((sql, params, future, monotonic()))
+        return future
+
+    def open(self):
+        # Other processes may hold the write lock, so wait for it rather than failing the batch
+        self.conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=self.cacheSize, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # FULL makes each commit durable before the ACKs waiting on it are sent
+        self.conn.execute("PRAGMA synchronous=FULL")
+
+    def close(self):
+        self.conn.close()
+        self.conn = None
+
+    def handleBatch(self, batch):
+        self.commit(self.conn, batch)
+
+    # Runs a batch in one transaction. A statement that fails only fails its own Future.
+    # Each statement is timed from when it was queued until its batch is committed
+    def commit(self, conn, batch):
+        results = []
+        started = monotonic()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params, future, queued in batch:
+                try:
+                    results.append((sql, future, queued, conn.execute(sql, params).fetchall(), None))
+                except sqlite3.IntegrityError as error:
+                    results.append((sql, future, queued, None, error))
+            conn.execute("COMMIT")
+        except sqlite3.Error as error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            self.metrics.inc("sqlite_batches_failed_total")
+            for sql, params, future, queued in batch:
+                future.set_exception(error)
+            return
+        committed = monotonic()
+        self.metrics.observe("sqlite_commit_seconds", committed - started)
+        self.metrics.inc("sqlite_batches_total")
+        self.metrics.inc("sqlite_rows_total", len(batch))
+        for sql, future, queued, rows, error in results:
+            statement = STATEMENTS.get(sql, "other")
+            self.metrics.observe("sqlite_write_seconds", committed - queued, statement=statement)
+            if error is not None:
+                self.metrics.inc("sqlite_errors_total", statement=statement, error=type(error).__name__)
+                future.set_exception(error)
+            else:
+                future.set_result(rows[0] if rows else None)
+
+
+# Keeps one open connection to the registration database for each worker thread, and sends every change
+# through a single GroupCommitWriter
+class IOTStorage:
+    def __init__(self, path='IOT.db', cacheSize=64, batchDelay=0.002, batchSize=256, metrics=None):
+        self.path = path
+        self.cacheSize = cacheSize
+        self.local = local()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.writer = GroupCommitWriter(path, batchDelay, batchSize, cacheSize, self.metrics)
+
+    # Returns this thread's connection, opening it the first time the thread asks
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=self.cacheSize)
+            # WAL lets readers carry on while another worker is writing
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def close(self):
+        self.writer.stop()
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def allDevices(self):
+        return self.connection().execute(FIND_ALL).fetchall()
+
+    def findByName(self, deviceName):
+        with self.metrics.timer("sqlite_read_seconds", query="name"):
+            return self.connection().execute(FIND_NAME, (deviceName,)).fetchall()
+
+    def findByIp(self, ip):
+        with self.metrics.timer("sqlite_read_seconds", query="ip"):
+            return self.connection().execute(FIND_IP, (ip,)).fetchall()
+
+    def findByMac(self, mac):
+        with self.metrics.timer("sqlite_read_seconds", query="mac"):
+            return self.connection().execute(FIND_MAC, (mac,)).fetchall()
+
+    def activeDevices(self):
+        with self.metrics.timer("sqlite_read_seconds", query="active"):
+            return self.connection().execute(FIND_ACTIVE).fetchall()
+
+    # Queues one change for the next group commit. The Future gives the row it touched, or None
+    def change(self, sql, params):
+        self.writer.start()
+        return self.writer.submit(sql, params)
+
+    def registerDevice(self, deviceName, passphrase, mac):
+        return self.change(REGISTER_DEVICE, (deviceName, passphrase, mac))
+
+    def loginDevice(self, deviceName, passphrase, ip, port):
+        return self.change(LOGIN_DEVICE, (ip, port, deviceName, passphrase))
+
+    def activateDevice(self, deviceName, ip, port):
+        return self.change(ACTIVATE_DEVICE, (ip, port, deviceName))
+
+    def logoffDevice(self, deviceName):
+        return self.change(LOGOFF_DEVICE, (deviceName,))
+
+    def deregisterDevice(self, deviceName):
+        return self.change(DEREGISTER_DEVICE, (deviceName,))
+
+    def logoffAll(self):
+        return self.change(LOGOFF_ALL, ())
@@ -0,0 +1,75 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from activitylog import BatchedFileHandler, FastQueueHandler, LogWriter, LOG_FORMAT, DATE_FORMAT
+
+
+# Counts how often the writer flushes the file
+class CountingHandler(BatchedFileHandler):
+    def __init__(self, filename):
+        BatchedFileHandler.__init__(self, filename)
+        self.flushes = 0
+        self.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+
+    def flushBatch(self):
+        self.flushes += 1
+        BatchedFileHandler.flushBatch(self)
+
+
+class LogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'Activity.log')
+        self.handler = CountingHandler(self.path)
+        self.writer = LogWriter(self.handler, flushDelay=10)
+        self.logger = logging.Logger('activitylog-test')
+        self.logger.addHandler(FastQueueHandler(self.writer.queue))
+
+    def tearDown(self):
+        self.writer.stop()
+        shutil.rmtree(self.folder)
+
+    def lines(self):
+        with open(self.path) as log:
+            return [line.rstrip('\n').split(' - ', 1)[1] for line in log]
+
+    def test_queued_records_are_written_in_one_flush(self):
+        for i in range(5):
+            self.logger.info("line %d", i)
+        self.writer.start()
+        self.writer.stop()
+        self.assertEqual(self.lines(), ["line %d" % i for i in range(5)])
+        self.assertEqual(self.handler.flushes, 1)
+        # The file is closed along with the writer
+        self.assertIsNone(self.handler.stream)
+
+    def test_full_batch_is_flushed_before_the_delay(self):
+        self.writer.batchSize = 2
+        for i in range(5):
+            self.logger.info("line %d", i)
+        self.writer.start()
+        self.writer.stop()
+        self.assertEqual(len(self.lines()), 5)
+        self.assertEqual(self.handler.flushes, 3)
+
+    def test_traceback_is_kept(self):
+        try:
+            raise RuntimeError("boom")
+        except RuntimeError:
+            self.logger.exception("failed")
+        self.writer.start()
+        self.writer.stop()
+        with open(self.path) as log:
+            text = log.read()
+        self.assertIn("failed", text)
+        self.assertIn("RuntimeError: boom", text)
+
+
+if __name__ == '__main__':
+    unittest.main()
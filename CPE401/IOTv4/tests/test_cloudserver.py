@@ -0,0 +1,99 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cloudserver import DataIngest, REGISTER_SQL, DATA_SQL
+
+SCHEMA = ['''CREATE TABLE devicelist (deviceID INTEGER constraint devicelist_pk primary key,
+                                     deviceName VARCHAR(32) not null)''',
+          '''CREATE TABLE messagebox (deviceID INTEGER constraint message_devicelist_deviceID_fk references devicelist,
+                                     messageID INTEGER constraint message_pk primary key autoincrement,
+                                     message VARCHAR(255))''']
+
+
+# Fails its first failures flushes with a busy database
+class BusyIngest(DataIngest):
+    def __init__(self, path, failures, **options):
+        DataIngest.__init__(self, path, retryDelay=0.001, **options)
+        self.failures = failures
+        self.tries = 0
+
+    def flush(self, conn, batch):
+        self.tries += 1
+        if self.tries <= self.failures:
+            raise sqlite3.OperationalError("database is locked")
+        DataIngest.flush(self, conn, batch)
+
+
+class DataIngestTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'IOTCloud.sqlite')
+        conn = sqlite3.connect(self.path)
+        for sql in SCHEMA:
+            conn.execute(sql)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def rows(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return (conn.execute("SELECT deviceID, deviceName FROM devicelist ORDER BY deviceID").fetchall(),
+                    conn.execute("SELECT deviceID, message FROM messagebox ORDER BY messageID").fetchall())
+        finally:
+            conn.close()
+
+    def counter(self, ingest, name):
+        return ingest.metrics.snapshot()["counters"].get(name, 0)
+
+    def test_rows_are_written_in_order(self):
+        ingest = DataIngest(self.path)
+        ingest.start()
+        ingest.add(REGISTER_SQL, (1, 'a'))
+        ingest.add(DATA_SQL, (1, 'first'))
+        ingest.add(REGISTER_SQL, (1, 'renamed'))
+        ingest.add(DATA_SQL, (1, 'second'))
+        ingest.stop()
+        self.assertEqual(self.rows(), ([(1, 'renamed')], [(1, 'first'), (1, 'second')]))
+        self.assertEqual(self.counter(ingest, "ingest_rows_total"), 4)
+
+    def test_busy_flush_is_retried(self):
+        ingest = BusyIngest(self.path, failures=2)
+        ingest.start()
+        ingest.add(DATA_SQL, (1, 'kept'))
+        ingest.stop()
+        self.assertEqual(self.rows()[1], [(1, 'kept')])
+        self.assertEqual(self.counter(ingest, "ingest_retries_total"), 2)
+        self.assertEqual(self.counter(ingest, "ingest_dropped_total"), 0)
+
+    def test_flush_is_dropped_once_retries_run_out(self):
+        ingest = BusyIngest(self.path, failures=100, retries=2)
+        ingest.start()
+        ingest.add(DATA_SQL, (1, 'lost'))
+        ingest.stop()
+        self.assertEqual(self.rows()[1], [])
+        self.assertEqual(self.counter(ingest, "ingest_dropped_total"), 1)
+        self.assertEqual(ingest.tries, 3)
+
+    def test_refused_row_only_drops_itself(self):
+        ingest = DataIngest(self.path, flushDelay=1)
+        ingest.add(REGISTER_SQL, (1, 'a'))
+        # deviceName cannot be NULL, so this row fails the whole executemany
+        ingest.add(REGISTER_SQL, (2, None))
+        ingest.add(DATA_SQL, (1, 'kept'))
+        ingest.start()
+        ingest.stop()
+        self.assertEqual(self.rows(), ([(1, 'a')], [(1, 'kept')]))
+        self.assertEqual(self.counter(ingest, "ingest_dropped_total"), 1)
+        self.assertEqual(self.counter(ingest, "ingest_rows_total"), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import unittest
+from threading import Event, Thread
+from time import sleep
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dispatch import BatchWorker, WorkerPool
+
+
+# Records every batch it is handed
+class RecordingWorker(BatchWorker):
+    def __init__(self, batchSize, batchDelay):
+        BatchWorker.__init__(self, batchSize, batchDelay)
+        self.batches = []
+        self.opened = False
+        self.closed = False
+
+    def open(self):
+        self.opened = True
+
+    def handleBatch(self, batch):
+        self.batches.append(batch)
+
+    def close(self):
+        self.closed = True
+
+
+class BatchWorkerTest(unittest.TestCase):
+    def test_items_queued_together_share_a_batch(self):
+        worker = RecordingWorker(batchSize=100, batchDelay=0.2)
+        for item in range(10):
+            worker.queue.put(item)
+        worker.start()
+        worker.stop()
+        self.assertEqual(worker.batches, [list(range(10))])
+        self.assertTrue(worker.opened and worker.closed)
+
+    def test_batches_stop_at_batch_size(self):
+        worker = RecordingWorker(batchSize=4, batchDelay=0.2)
+        for item in range(10):
+            worker.queue.put(item)
+        worker.start()
+        worker.stop()
+        self.assertEqual(worker.batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_stop_handles_what_is_still_queued(self):
+        worker = RecordingWorker(batchSize=100, batchDelay=10)
+        worker.start()
+        worker.queue.put('a')
+        # The delay is far longer than the test, so only stop can end this batch
+        worker.stop()
+        self.assertEqual(worker.batches, [['a']])
+        self.assertIsNone(worker.thread)
+
+    def test_batch_ends_when_the_delay_runs_out(self):
+        handled = Event()
+
+        class Worker(RecordingWorker):
+            def handleBatch(self, batch):
+                RecordingWorker.handleBatch(self, batch)
+                handled.set()
+
+        worker = Worker(batchSize=100, batchDelay=0.01)
+        worker.start()
+        worker.queue.put('a')
+        self.assertTrue(handled.wait(5))
+        worker.queue.put('b')
+        worker.stop()
+        self.assertEqual(worker.batches, [['a'], ['b']])
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_results_and_errors_reach_the_future(self):
+        pool = WorkerPool(size=2, depth=8)
+        pool.start()
+        self.assertEqual(pool.submit(pow, 2, 10).result(5), 1024)
+        with self.assertRaises(ZeroDivisionError):
+            pool.submit(divmod, 1, 0).result(5)
+        stats = pool.stats()
+        self.assertEqual((stats["workers"], stats["capacity"], stats["submitted"]), (2, 8, 2))
+
+    def test_submit_blocks_while_the_queue_is_full(self):
+        pool = WorkerPool(size=1, depth=1)
+        release = Event()
+        pool.start()
+        running = pool.submit(release.wait)
+        # Wait until the worker holds the first job, so the next one fills the queue
+        while pool.queue.qsize():
+            sleep(0.001)
+        pool.submit(len, 'queued')
+        submitted = Event()
+        late = []
+
+        def submitLate():
+            late.append(pool.submit(len, 'late'))
+            submitted.set()
+
+        Thread(target=submitLate, daemon=True).start()
+        self.assertFalse(submitted.wait(0.1))
+        release.set()
+        self.assertTrue(submitted.wait(5))
+        self.assertTrue(running.result(5))
+        self.assertEqual(late[0].result(5), 4)
+        stats = pool.stats()
+        self.assertEqual((stats["submitted"], stats["blocked"], stats["maxDepth"]), (3, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
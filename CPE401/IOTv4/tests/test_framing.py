@@ -0,0 +1,38 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framing import encodeFrame, FrameBuffer, MAX_FRAME, frameHeader
+
+
+class FrameBufferTest(unittest.TestCase):
+    def test_round_trip_split_across_reads(self):
+        messages = [b'REGISTER\ta\ttoor\t00:11', b'', b'x' * 5000]
+        stream = b''.join(encodeFrame(message) for message in messages)
+        buffer = FrameBuffer()
+        received = []
+        for i in range(0, len(stream), 7):
+            received += buffer.feed(stream[i:i + 7])
+        self.assertEqual(received, messages)
+        self.assertTrue(buffer.framed)
+
+    def test_several_frames_in_one_read(self):
+        buffer = FrameBuffer()
+        self.assertEqual(buffer.feed(encodeFrame(b'a') + encodeFrame(b'bc')), [b'a', b'bc'])
+
+    def test_frame_over_limit_is_rejected(self):
+        buffer = FrameBuffer()
+        with self.assertRaises(ValueError):
+            buffer.feed(frameHeader.pack(MAX_FRAME + 1))
+
+    def test_unframed_device_gets_one_message_per_read(self):
+        buffer = FrameBuffer()
+        self.assertEqual(buffer.feed(b'REGISTER\ta\ttoor\t00:11'), [b'REGISTER\ta\ttoor\t00:11'])
+        self.assertEqual(buffer.feed(b'LOGOFF\ta'), [b'LOGOFF\ta'])
+        self.assertIs(buffer.framed, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tokens import TokenSigner, isToken, tokenExpiry, saveToken, loadToken, removeToken, loadOrCreateSecret
+
+
+class TokenSignerTest(unittest.TestCase):
+    def test_issue_and_check(self):
+        signer = TokenSigner()
+        token = signer.issue('a')
+        self.assertTrue(isToken(token))
+        self.assertTrue(signer.check('a', token))
+        self.assertAlmostEqual(tokenExpiry(token), time() + signer.lifetime, delta=5)
+
+    def test_refused(self):
+        signer = TokenSigner()
+        token = signer.issue('a')
+        # Another device, another server's secret, a changed expiry and garbage are all refused
+        self.assertFalse(signer.check('b', token))
+        self.assertFalse(TokenSigner().check('a', token))
+        issued, expires, signature = token[2:].split(':')
+        self.assertFalse(signer.check('a', 'T:%s:%d:%s' % (issued, int(expires) + 1000, signature)))
+        self.assertFalse(signer.check('a', 'T:not-a-token'))
+        self.assertFalse(signer.check('a', 'T:1:2:3:4'))
+
+    def test_expired(self):
+        signer = TokenSigner(lifetime=-1)
+        self.assertFalse(signer.check('a', signer.issue('a')))
+
+    def test_revoked(self):
+        signer = TokenSigner()
+        token = signer.issue('a')
+        signer.revoke('a')
+        self.assertFalse(signer.check('a', token))
+        self.assertTrue(signer.check('b', signer.issue('b')))
+
+
+class TokenFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'keys', 'a.token')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_save_load_remove(self):
+        token = TokenSigner().issue('a')
+        saveToken(token, self.path)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(loadToken(self.path), token)
+        removeToken(self.path)
+        self.assertIsNone(loadToken(self.path))
+
+    def test_expired_token_is_not_loaded(self):
+        saveToken(TokenSigner(lifetime=-1).issue('a'), self.path)
+        self.assertIsNone(loadToken(self.path))
+
+    def test_tokens_outlive_a_restart(self):
+        path = os.path.join(self.folder, 'ServerToken.key')
+        token = TokenSigner(secret=loadOrCreateSecret(path)).issue('a')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertTrue(TokenSigner(secret=loadOrCreateSecret(path)).check('a', token))
+
+
+if __name__ == '__main__':
+    unittest.main()
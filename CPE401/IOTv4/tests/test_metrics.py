@@ -0,0 +1,91 @@
+import json
+import os
+import sys
+import unittest
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import Metrics, Histogram, BUCKETS
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentile_is_the_bound_of_its_bucket(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        for seconds in [0.0002] * 98 + [0.003, 30.0]:
+            histogram.observe(seconds)
+        self.assertEqual(histogram.percentile(0.50), 0.00025)
+        self.assertEqual(histogram.percentile(0.99), 0.005)
+        self.assertEqual(histogram.percentile(1.0), float('inf'))
+        self.assertEqual(histogram.count, 100)
+
+    def test_bound_itself_falls_in_its_bucket(self):
+        histogram = Histogram()
+        histogram.observe(BUCKETS[0])
+        self.assertEqual(histogram.counts[0], 1)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counters_are_kept_per_label_set(self):
+        self.metrics.inc("acks_total", code="70")
+        self.metrics.inc("acks_total", 2, code="70")
+        self.metrics.inc("acks_total", code="01")
+        self.metrics.inc("messages_total")
+        counters = self.metrics.snapshot()["counters"]
+        self.assertEqual(counters, {'acks_total{code="70"}': 3, 'acks_total{code="01"}': 1, 'messages_total': 1})
+
+    def test_label_order_does_not_matter(self):
+        self.metrics.inc("errors_total", statement="login", error="IntegrityError")
+        self.metrics.inc("errors_total", error="IntegrityError", statement="login")
+        self.assertEqual(self.metrics.snapshot()["counters"],
+                         {'errors_total{error="IntegrityError",statement="login"}': 2})
+
+    def test_timer_observes_into_a_histogram(self):
+        with self.metrics.timer("read_seconds", query="name"):
+            pass
+        histogram = self.metrics.snapshot()["histograms"]['read_seconds{query="name"}']
+        self.assertEqual(histogram["count"], 1)
+        self.assertEqual(histogram["p50Ms"], BUCKETS[0] * 1000)
+
+    def test_gauges_are_read_when_asked_for(self):
+        depth = [3]
+        self.metrics.addGauge("queue_depth", lambda: depth[0])
+        self.metrics.addGauge("pool", lambda: {"workers": 8, "blocked": 1})
+        depth[0] = 5
+        self.assertEqual(self.metrics.snapshot()["gauges"], {"queue_depth": 5, "pool_workers": 8, "pool_blocked": 1})
+
+    def test_render_uses_the_prometheus_text_format(self):
+        self.metrics.inc("acks_total", code="70")
+        self.metrics.observe("handle_seconds", 0.003, type="DATA")
+        self.metrics.addGauge("queue_depth", lambda: 2)
+        lines = self.metrics.render().splitlines()
+        self.assertIn('# TYPE acks_total counter', lines)
+        self.assertIn('acks_total{code="70"} 1', lines)
+        self.assertIn('# TYPE handle_seconds histogram', lines)
+        # Buckets are cumulative
+        self.assertIn('handle_seconds_bucket{type="DATA",le="0.0025"} 0', lines)
+        self.assertIn('handle_seconds_bucket{type="DATA",le="0.005"} 1', lines)
+        self.assertIn('handle_seconds_bucket{type="DATA",le="+Inf"} 1', lines)
+        self.assertIn('handle_seconds_count{type="DATA"} 1', lines)
+        self.assertIn('queue_depth 2', lines)
+
+    def test_serve_answers_both_endpoints(self):
+        self.metrics.inc("messages_total")
+        server = self.metrics.serve("127.0.0.1", 0)
+        try:
+            base = "http://127.0.0.1:%d" % server.server_address[1]
+            with urlopen(base + "/metrics") as reply:
+                self.assertIn("messages_total 1", reply.read().decode())
+            with urlopen(base + "/metrics.json") as reply:
+                self.assertEqual(json.loads(reply.read())["counters"], {"messages_total": 1})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
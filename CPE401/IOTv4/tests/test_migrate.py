@@ -0,0 +1,75 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migrate import upgradeDatabase, pemToDer, MigrationError, MIGRATIONS
+
+SCHEMA = '''CREATE TABLE registration (deviceID INTEGER not null constraint registration_pk primary key autoincrement,
+                                      deviceName VARCHAR(32) not null, passphrase VARCHAR(16) not null,
+                                      mac VARCHAR(17) not null, ip VARCHAR(15), port INTEGER, active NUMERIC)'''
+KEYS = '''CREATE TABLE Keys (deviceid INTEGER constraint Keys_pk primary key, deviceName varchar(255) not null,
+                             publicKey varchar(1500))'''
+DER = bytes(range(48, 120))
+PEM = b'-----BEGIN PUBLIC KEY-----\nMDEyMzQ1Njc4OTo7PD0+P0BBQkNERUZHSElKS0xNTk9QUVJTVFVWV1hZWltcXV5fYGFiY2RlZmdo\naWprbG1ub3BxcnN0dXZ3\n-----END PUBLIC KEY-----'
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'IOT.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute(SCHEMA)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def query(self, sql):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_upgrade_runs_once(self):
+        self.assertEqual(upgradeDatabase(self.path), (0, len(MIGRATIONS)))
+        self.assertEqual(upgradeDatabase(self.path), (len(MIGRATIONS), len(MIGRATIONS)))
+        names = [row[0] for row in self.query("SELECT name FROM sqlite_master WHERE type='index'")]
+        self.assertIn('registration_mac_uindex', names)
+
+    def test_duplicates_stop_the_upgrade(self):
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO registration(deviceName, passphrase, mac) VALUES(?,?,?)",
+                         [('a', 'toor', 'm1'), ('b', 'toor', 'm1')])
+        conn.commit()
+        conn.close()
+        with self.assertRaises(MigrationError):
+            upgradeDatabase(self.path)
+        self.assertEqual(self.query("PRAGMA user_version"), [(0,)])
+
+    def test_pem_to_der(self):
+        self.assertEqual(pemToDer(PEM), DER)
+        with self.assertRaises(ValueError):
+            pemToDer(b'not a key')
+
+    def test_text_keys_become_der(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(KEYS)
+        # The first row is how the sierra server used to save keys, str() of the PEM bytes
+        conn.executemany("INSERT INTO Keys(deviceName, publicKey) VALUES(?,?)",
+                         [('a', str(PEM)), ('b', PEM.decode('ascii')), ('c', DER), ('d', 'garbage')])
+        conn.commit()
+        conn.close()
+        upgradeDatabase(self.path)
+        self.assertEqual(self.query("SELECT deviceName, publicKey FROM Keys ORDER BY deviceName"),
+                         [('a', DER), ('b', DER), ('c', DER), ('d', 'garbage')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from protocol import encodeBinary, encodeMessage, decodeMessage, tagMessage, untagMessage, digestMessage, \
+    verifyDigest, ASCII, BINARY, SHA256, BLAKE2
+
+DIGEST = '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08'
+MESSAGES = [['REGISTER', 'sensor1', 'toor', '00:16:3e:00:00:01'],
+            ['DEREGISTER', 'sensor1', 'toor', '00:16:3e:00:00:01'],
+            ['LOGIN', 'sensor1', 'toor', '10.0.0.5', '5000'],
+            ['LOGOFF', 'sensor1'],
+            ['DATA', '01', 'sensor1', '1551312000', '11', 'Sensor Data'],
+            ['DATA', '02', 'cloud.example.com', '59000'],
+            ['QUERY', '01', 'Server', '1551312000', 'sensor1'],
+            ['ACK', '70', 'sensor1', '1551312000', DIGEST],
+            # Fields that do not fit a layout go as ASCII inside the binary encoding
+            ['ACK', '70', 'sensor1', '01551312000', DIGEST],
+            ['ACK', '70', 'sensor1', '1551312000', DIGEST.upper()],
+            ['DATA', '01', 'sensor1', '1551312000', '99999999999', 'x'],
+            ['REGISTER', 'x' * 300, 'toor', '00:16:3e:00:00:01'],
+            ['STATUS', '01', 'sensor1']]
+
+
+class ProtocolTest(unittest.TestCase):
+    def test_round_trip(self):
+        for codec in (ASCII, BINARY):
+            for message in MESSAGES:
+                for fields in (message, tagMessage(message, 42)):
+                    self.assertEqual(decodeMessage(encodeMessage(fields, codec)), fields)
+
+    def test_binary_is_smaller(self):
+        ack = MESSAGES[7]
+        self.assertLess(len(encodeBinary(ack)), len(encodeMessage(ack, ASCII)))
+
+    def test_untag(self):
+        self.assertEqual(untagMessage(['#7', 'LOGOFF', 'a']), (7, ['LOGOFF', 'a']))
+        self.assertEqual(untagMessage(['LOGOFF', 'a']), (None, ['LOGOFF', 'a']))
+
+    def test_malformed_binary_raises_value_error(self):
+        ack = encodeBinary(tagMessage(MESSAGES[7], 3))
+        frames = [bytes([9]), bytes([9 | 0x80, 0, 0, 0, 1]), bytes([0x80, 1]), bytes([8]),
+                  ack[:-1], ack + b'x', bytes([0]) + b'\xff']
+        for frame in frames:
+            with self.assertRaises(ValueError):
+                decodeMessage(frame)
+
+    def test_digests(self):
+        ack = MESSAGES[4]
+        for digest in (SHA256, BLAKE2):
+            hexdigest = digestMessage(ack, digest)
+            self.assertEqual(len(hexdigest), 64)
+            self.assertTrue(verifyDigest(ack, hexdigest, digest))
+            self.assertFalse(verifyDigest(MESSAGES[3], hexdigest, digest))
+        self.assertNotEqual(digestMessage(ack, SHA256), digestMessage(ack, BLAKE2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migrate import upgradeDatabase
+from registry import DeviceRegistry, ConnectionRegistry, ACTIVE, IP
+from storage import IOTStorage
+
+SCHEMA = '''CREATE TABLE registration (deviceID INTEGER not null constraint registration_pk primary key autoincrement,
+                                      deviceName VARCHAR(32) not null, passphrase VARCHAR(16) not null,
+                                      mac VARCHAR(17) not null, ip VARCHAR(15), port INTEGER, active NUMERIC)'''
+
+
+class DeviceRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        path = os.path.join(self.folder, 'IOT.db')
+        conn = sqlite3.connect(path)
+        conn.execute(SCHEMA)
+        conn.close()
+        upgradeDatabase(path)
+        self.db = IOTStorage(path, batchDelay=0)
+        self.registry = DeviceRegistry(self.db)
+        self.registry.load()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.folder)
+
+    def test_register_login_logoff_deregister(self):
+        self.assertIsNotNone(self.registry.registerDevice('a', 'toor', 'm1').result())
+        # The same name again changes nothing
+        self.assertIsNone(self.registry.registerDevice('a', 'toor', 'm1').result())
+        self.assertIsNone(self.registry.loginDevice('a', 'wrong', '10.0.0.5', 5000).result())
+        self.assertIsNotNone(self.registry.loginDevice('a', 'toor', '10.0.0.5', 5000).result())
+        row = self.registry.findByName('a')[0]
+        self.assertEqual((row[ACTIVE], row[IP]), (1, '10.0.0.5'))
+        self.assertEqual([r[1] for r in self.registry.findByIp('10.0.0.5')], ['a'])
+        self.assertEqual([r[1] for r in self.registry.activeDevices()], ['a'])
+        # Already logged in
+        self.assertIsNone(self.registry.loginDevice('a', 'toor', '10.0.0.5', 5000).result())
+        self.assertIsNotNone(self.registry.logoffDevice('a').result())
+        self.assertEqual(self.registry.activeDevices(), [])
+        self.assertIsNotNone(self.registry.deregisterDevice('a').result())
+        self.assertEqual(self.registry.findByName('a'), [])
+        self.assertEqual(self.registry.findByMac('m1'), [])
+
+    def test_mac_in_use_fails(self):
+        self.registry.registerDevice('a', 'toor', 'm1').result()
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.registry.registerDevice('b', 'toor', 'm1').result()
+        self.assertEqual(self.registry.findByName('b'), [])
+
+    def test_memory_matches_database(self):
+        self.registry.registerDevice('a', 'toor', 'm1').result()
+        self.registry.loginDevice('a', 'toor', '10.0.0.5', 5000).result()
+        self.registry.shared = True
+        fromDatabase = self.registry.findByName('a')
+        self.registry.shared = False
+        self.assertEqual(self.registry.findByName('a'), [tuple(row) for row in fromDatabase])
+
+
+class ConnectionRegistryTest(unittest.TestCase):
+    def test_add_replace_drop(self):
+        connections = ConnectionRegistry()
+        first, second = object(), object()
+        connections.add('a', first)
+        connections.add('a', second)
+        self.assertIs(connections.get('a'), second)
+        # The old connection closing does not detach the device from the new one
+        self.assertIsNone(connections.drop(first))
+        self.assertIs(connections.get('a'), second)
+        self.assertEqual(connections.drop(second), 'a')
+        self.assertIsNone(connections.get('a'))
+        self.assertEqual(len(connections), 0)
+
+    def test_remove(self):
+        connections = ConnectionRegistry()
+        connect = object()
+        connections.add('a', connect)
+        connections.remove('a')
+        self.assertIsNone(connections.drop(connect))
+        self.assertEqual(len(connections), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from concurrent.futures import Future
+from socket import socketpair
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framing import encodeFrame, FrameBuffer
+from protocol import encodeAscii, decodeMessage
+from IOTServer import IOTserver, SocketConnection
+
+SCHEMA = '''CREATE TABLE registration (deviceID INTEGER not null constraint registration_pk primary key autoincrement,
+                                      deviceName VARCHAR(32) not null, passphrase VARCHAR(16) not null,
+                                      mac VARCHAR(17) not null, ip VARCHAR(15), port INTEGER, active NUMERIC)'''
+
+
+# Serves one end of a socket pair, the test plays the device on the other end
+class ServerTest(unittest.TestCase):
+    useAsyncio = False
+
+    def setUp(self):
+        self.home = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.chdir(self.folder)
+        conn = sqlite3.connect('IOT.db')
+        conn.execute(SCHEMA)
+        conn.close()
+        self.server = IOTserver(0, batchDelay=0)
+        self.server.loadRegistry()
+        self.server.pool.start()
+        self.device, serverSide = socketpair()
+        self.device.settimeout(5)
+        self.buffer = FrameBuffer()
+        self.replies = []
+        if self.useAsyncio:
+            self.thread = Thread(target=asyncio.run, args=(self.serveAsync(serverSide),), daemon=True)
+        else:
+            self.thread = Thread(target=self.server.recieveData, args=(SocketConnection(serverSide),), daemon=True)
+        self.thread.start()
+
+    async def serveAsync(self, sock):
+        self.server.slots = asyncio.Semaphore(self.server.pool.depth)
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.server.asyncRecieveData(reader, writer)
+
+    def tearDown(self):
+        self.device.close()
+        self.thread.join(5)
+        self.server.db.close()
+        os.chdir(self.home)
+        shutil.rmtree(self.folder)
+
+    def send(self, *fields):
+        self.device.sendall(encodeFrame(encodeAscii(list(fields))))
+
+    # The next message from the server, or None once it has closed the connection
+    def reply(self):
+        while not self.replies:
+            data = self.device.recv(2048)
+            if not data:
+                return None
+            self.replies += [decodeMessage(frame) for frame in self.buffer.feed(data)]
+        return self.replies.pop(0)
+
+    def malformed(self):
+        return self.server.metrics.snapshot()["counters"].get("messages_malformed_total", 0)
+
+    def test_short_messages_are_malformed(self):
+        self.send('LOGIN', 'a', 'toor')
+        self.assertIsNone(self.reply())
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(self.malformed(), 1)
+
+    def test_whole_messages_are_answered(self):
+        self.send('LOGOFF', 'a')
+        self.assertEqual(self.reply()[:3], ['ACK', '31', 'a'])
+        self.assertEqual(self.malformed(), 0)
+
+    def test_failed_commit_keeps_the_connection(self):
+        failed = Future()
+        failed.set_exception(sqlite3.OperationalError("database is locked"))
+        self.server.registry.registerDevice = lambda deviceName, passphrase, mac: failed
+        self.send('REGISTER', 'a', 'toor', 'm1')
+        self.send('LOGOFF', 'a')
+        # The REGISTER gets no ACK, the LOGOFF after it still does
+        self.assertEqual(self.reply()[:3], ['ACK', '31', 'a'])
+        self.assertTrue(self.thread.is_alive())
+        errors = self.server.metrics.snapshot()["counters"]
+        self.assertEqual(errors.get('message_errors_total{type="REGISTER"}'), 1)
+
+
+class AsyncServerTest(ServerTest):
+    useAsyncio = True
+
+
+if __name__ == '__main__':
+    unittest.main()
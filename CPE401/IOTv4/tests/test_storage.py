@@ -0,0 +1,79 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migrate import upgradeDatabase
+from storage import GroupCommitWriter, REGISTER_DEVICE, LOGIN_DEVICE
+
+SCHEMA = '''CREATE TABLE registration (deviceID INTEGER not null constraint registration_pk primary key autoincrement,
+                                      deviceName VARCHAR(32) not null, passphrase VARCHAR(16) not null,
+                                      mac VARCHAR(17) not null, ip VARCHAR(15), port INTEGER, active NUMERIC)'''
+
+
+class GroupCommitWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'IOT.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute(SCHEMA)
+        conn.close()
+        upgradeDatabase(self.path)
+        self.writer = GroupCommitWriter(self.path, batchDelay=10)
+
+    def tearDown(self):
+        self.writer.stop()
+        shutil.rmtree(self.folder)
+
+    def counter(self, name):
+        return self.writer.metrics.snapshot()["counters"].get(name, 0)
+
+    def names(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return [row[0] for row in conn.execute("SELECT deviceName FROM registration ORDER BY deviceID")]
+        finally:
+            conn.close()
+
+    def test_queued_changes_share_one_commit(self):
+        futures = [self.writer.submit(REGISTER_DEVICE, ('d%d' % i, 'toor', 'm%d' % i)) for i in range(5)]
+        self.writer.start()
+        self.writer.stop()
+        self.assertEqual([future.result()[1] for future in futures], ['d%d' % i for i in range(5)])
+        self.assertEqual(self.names(), ['d%d' % i for i in range(5)])
+        self.assertEqual(self.counter("sqlite_batches_total"), 1)
+        self.assertEqual(self.counter("sqlite_rows_total"), 5)
+
+    def test_refused_change_only_fails_its_own_future(self):
+        first = self.writer.submit(REGISTER_DEVICE, ('a', 'toor', 'm1'))
+        # The MAC already belongs to a
+        clash = self.writer.submit(REGISTER_DEVICE, ('b', 'toor', 'm1'))
+        last = self.writer.submit(REGISTER_DEVICE, ('c', 'toor', 'm2'))
+        self.writer.start()
+        self.writer.stop()
+        self.assertIsNotNone(first.result())
+        self.assertIsInstance(clash.exception(), sqlite3.IntegrityError)
+        self.assertIsNotNone(last.result())
+        self.assertEqual(self.names(), ['a', 'c'])
+
+    def test_change_that_matches_nothing_gives_none(self):
+        future = self.writer.submit(LOGIN_DEVICE, ('10.0.0.5', 5000, 'missing', 'toor'))
+        self.writer.start()
+        self.writer.stop()
+        self.assertIsNone(future.result())
+
+    def test_stop_commits_what_is_still_queued(self):
+        self.writer.start()
+        future = self.writer.submit(REGISTER_DEVICE, ('a', 'toor', 'm1'))
+        # The batch delay is far longer than the test, so only stop can end this batch
+        self.writer.stop()
+        self.assertTrue(future.done())
+        self.assertEqual(self.names(), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Program: Login tokens for the University of Nevada, Reno CPE 401 IOT server and client
+# Filename: tokens.py
+# Date Created: 18 Oct 2026
+# Version: 1.0
+
+# A successful LOGIN is answered with ACK<tab>70<tab>...<tab>token. The device sends the token in place of its
+# passphrase the next time it logs in, so the passphrase is only sent once per token lifetime. A token that is
+# expired, revoked or not signed by this server gets ACK 71, and the device logs in with its passphrase again.
+# Tokens look like T:<issued ms>:<expires ms>:<HMAC-SHA256 hex>. The signing secret is kept on disk and read by
+# every worker, so a token works on any worker and after the server restarts.
+# The sierra server runs on its own from the sierra folder and has the same tokens in sierra/tokens.py
+
+import hashlib
+import hmac
+import os
+from threading import Lock
+from time import time
+
+TOKEN_PREFIX = "T:"
+TOKEN_LIFETIME = 3600
+SECRET_BYTES = 32
+
+
+# Passphrases never start with the prefix, so a token can be told apart from one
+def isToken(text):
+    return text.startswith(TOKEN_PREFIX)
+
+
+# Issues and checks tokens. Without a secret one is made that only lives as long as the process
+class TokenSigner:
+    def __init__(self, lifetime=TOKEN_LIFETIME, secret=None):
+        self.secret = secret if secret is not None else os.urandom(SECRET_BYTES)
+        self.lifetime = lifetime
+        # When each device last logged off or deregistered in this process, tokens issued before then are refused
+        self.revoked = {}
+        self.lock = Lock()
+
+    def sign(self, deviceName, issued, expires):
+        text = "%s\t%d\t%d" % (deviceName, issued, expires)
+        return hmac.new(self.secret, text.encode('ascii'), hashlib.sha256).hexdigest()
+
+    def issue(self, deviceName):
+        issued = int(time() * 1000)
+        expires = issued + int(self.lifetime * 1000)
+        return "%s%d:%d:%s" % (TOKEN_PREFIX, issued, expires, self.sign(deviceName, issued, expires))
+
+    def check(self, deviceName, token):
+        try:
+            issuedText, expiresText, signature = token[len(TOKEN_PREFIX):].split(':')
+            issued = int(issuedText)
+            expires = int(expiresText)
+        except ValueError:
+            return False
+        if not hmac.compare_digest(self.sign(deviceName, issued, expires), signature):
+            return False
+        with self.lock:
+            revokedAt = self.revoked.get(deviceName, 0)
+        return issued > revokedAt and time() * 1000 < expires
+
+    def revoke(self, deviceName):
+        with self.lock:
+            self.revoked[deviceName] = int(time() * 1000)
+
+
+# Writes a file only this user can read. It is written to a temporary file first, so a crash part way
+# through never leaves a half written file behind
+def saveSecret(data, path):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    temp = path + '.tmp'
+    descriptor = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as secretFile:
+        secretFile.write(data)
+    os.replace(temp, path)
+
+
+# Reads the signing secret saved at path, or makes one and saves it there
+def loadOrCreateSecret(path):
+    try:
+        with open(path, 'rb') as secretFile:
+            secret = secretFile.read()
+        if len(secret) == SECRET_BYTES:
+            return secret
+    except FileNotFoundError:
+        pass
+    secret = os.urandom(SECRET_BYTES)
+    saveSecret(secret, path)
+    return secret
+
+
+# When a token runs out, in seconds since the epoch, or None if it is not a token
+def tokenExpiry(token):
+    try:
+        return int(token[len(TOKEN_PREFIX):].split(':')[1]) / 1000
+    except (ValueError, IndexError):
+        return None
+
+
+# Keeps a device's token on disk so it survives the device restarting
+def saveToken(token, path):
+    saveSecret(token.encode('ascii'), path)
+
+
+# Returns the token saved at path, or None if there is none or it has run out
+def loadToken(path):
+    try:
+        with open(path) as tokenFile:
+            token = tokenFile.read().strip()
+    except OSError:
+        return None
+    expires = tokenExpiry(token)
+    if not isToken(token) or expires is None or expires <= time():
+        return None
+    return token
+
+
+def removeToken(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass